@@ -20,3 +20,10 @@ LOCAL_MODULE := fs_config
 LOCAL_FORCE_STATIC_EXECUTABLE := true
 
 include $(BUILD_HOST_EXECUTABLE)
+
+# The rules compiled into fs_config, as a table that releasetools
+# reads instead of running fs_config on every path.
+FS_CONFIG_TABLE := $(HOST_OUT_EXECUTABLES)/fs_config.table
+$(FS_CONFIG_TABLE): $(LOCAL_INSTALLED_MODULE)
+	@echo "Generate: $@"
+	$(hide) $< -t > $@
@@ -39,10 +39,34 @@
 //
 // Note that the output will omit the trailing slash from
 // directories.
+//
+// With -t, it instead prints the rules it applies (the android_dirs
+// and android_files tables), one per line, in the order they are
+// tried:
+//
+//    dir 771 1000 1000 data/app
+//    file 440 1002 1002 system/etc/dbus.conf
+//
+// A line with no path prefix is the default for paths that match no
+// other rule of its kind.  The build saves this output next to the
+// binary as fs_config.table, for releasetools to read.
+
+static void print_rules(const char* kind, const struct fs_path_config* pc) {
+  for (; pc->prefix; ++pc) {
+    printf("%s %o %d %d %s\n", kind, pc->mode, pc->uid, pc->gid, pc->prefix);
+  }
+  printf("%s %o %d %d\n", kind, pc->mode, pc->uid, pc->gid);
+}
 
 int main(int argc, char** argv) {
   char buffer[1024];
 
+  if (argc == 2 && strcmp(argv[1], "-t") == 0) {
+    print_rules("dir", android_dirs);
+    print_rules("file", android_files);
+    return 0;
+  }
+
   while (fgets(buffer, 1023, stdin) != NULL) {
     int is_dir = 0;
     int i;
@@ -0,0 +1,486 @@
+# Copyright (C) 2014 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Block-level differences between two filesystem images, for
+block-based incremental OTAs.
+
+The target image is compared with the source one block by block.
+Blocks that are the same in both are left alone; the rest are covered
+by a list of transfers that the updater's block_image_update()
+applies, in order, to the partition:
+
+  zero <tgt>          fill the blocks with zeros
+  new <tgt>           fill the blocks from the next part of the new
+                      data file
+  move <src> <tgt>    copy the source blocks to the target blocks
+  bsdiff <offset> <length> <src> <tgt>
+                      apply the patch at <offset> in the patch data
+                      file to the source blocks, and write the result
+                      to the target blocks
+
+where <src> and <tgt> are block ranges written as by RangeSet.ToRaw().
+Each transfer reads all of its source blocks before writing any of its
+target blocks.
+"""
+
+import bisect
+import heapq
+import os
+import struct
+import threading
+import zipfile
+
+try:
+  from hashlib import sha1 as sha1
+except ImportError:
+  from sha import sha as sha1
+
+import common
+
+BLOCK_SIZE = 4096
+
+# Most blocks a single bsdiff transfer covers, so the patches can be
+# computed in parallel and each diff stays small.
+MAX_PATCH_BLOCKS = 1024
+
+# Blocks read (and hashed) at a time.
+READ_BLOCKS = 256
+
+SPARSE_HEADER_MAGIC = 0xed26ff3a
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+
+class RangeSet(object):
+  """A set of block numbers, held as a sorted list of disjoint,
+  non-adjacent half-open (start, end) ranges."""
+
+  def __init__(self, ranges=()):
+    self.ranges = []
+    for start, end in sorted(ranges):
+      if start >= end:
+        continue
+      if self.ranges and start <= self.ranges[-1][1]:
+        if end > self.ranges[-1][1]:
+          self.ranges[-1] = (self.ranges[-1][0], end)
+      else:
+        self.ranges.append((start, end))
+    self.size = sum([e - s for s, e in self.ranges])
+
+  @classmethod
+  def FromBlocks(cls, blocks):
+    """Return the RangeSet of the given ascending block numbers."""
+    ranges = []
+    for b in blocks:
+      if ranges and ranges[-1][1] == b:
+        ranges[-1][1] = b + 1
+      else:
+        ranges.append([b, b + 1])
+    return cls(ranges)
+
+  def __iter__(self):
+    return iter(self.ranges)
+
+  def __nonzero__(self):
+    return bool(self.ranges)
+
+  def __repr__(self):
+    return "<RangeSet %s>" % (self.ToRaw(),)
+
+  def Intersect(self, other):
+    out = []
+    a, b = self.ranges, other.ranges
+    i = j = 0
+    while i < len(a) and j < len(b):
+      start = max(a[i][0], b[j][0])
+      end = min(a[i][1], b[j][1])
+      if start < end:
+        out.append((start, end))
+      if a[i][1] < b[j][1]:
+        i += 1
+      else:
+        j += 1
+    return RangeSet(out)
+
+  def ToRaw(self):
+    """Return the set the way the updater parses it: the count of the
+    numbers that follow, then the start and end of each range, all
+    separated by commas."""
+    nums = []
+    for s, e in self.ranges:
+      nums.append(s)
+      nums.append(e)
+    return ",".join([str(len(nums))] + [str(i) for i in nums])
+
+
+class Image(object):
+  """A read-only view of a filesystem image as an array of blocks.
+  Both raw images and Android sparse images are supported.  care_map
+  is the RangeSet of blocks that hold data; the "don't care" chunks of
+  a sparse image are left out of it (and read as zeros)."""
+
+  def __init__(self, path):
+    self.path = path
+    self.f = open(path, "rb")
+    self.lock = threading.Lock()
+    header = self.f.read(28)
+    if (len(header) == 28 and
+        struct.unpack("<I", header[:4])[0] == SPARSE_HEADER_MAGIC):
+      self._LoadSparse(header)
+    else:
+      size = os.path.getsize(path)
+      if size % BLOCK_SIZE != 0:
+        raise common.ExternalError(
+            "%s: size %d is not a multiple of the block size"
+            % (path, size))
+      self.block_size = BLOCK_SIZE
+      self.total_blocks = size / BLOCK_SIZE
+      # (start block, end block, file offset, fill data); the offset
+      # is None for fill chunks.
+      self.chunks = [(0, self.total_blocks, 0, None)]
+      self.care_map = RangeSet([(0, self.total_blocks)])
+    self.chunk_starts = [c[0] for c in self.chunks]
+
+  def _LoadSparse(self, header):
+    (_, major, _, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks,
+     total_chunks, _) = struct.unpack("<I4H4I", header)
+    if major != 1:
+      raise common.ExternalError("%s: unknown sparse image version %d"
+                                 % (self.path, major))
+    self.block_size = blk_sz
+    self.total_blocks = total_blks
+    self.chunks = []
+    care = []
+    pos = 0
+    self.f.seek(file_hdr_sz)
+    for i in range(total_chunks):
+      chunk_type, _, chunk_sz, total_sz = struct.unpack(
+          "<2H2I", self.f.read(chunk_hdr_sz)[:12])
+      data_start = self.f.tell()
+      data_sz = total_sz - chunk_hdr_sz
+      if chunk_type == CHUNK_TYPE_RAW:
+        if data_sz != chunk_sz * blk_sz:
+          raise common.ExternalError("%s: bad raw chunk at block %d"
+                                     % (self.path, pos))
+        self.chunks.append((pos, pos + chunk_sz, data_start, None))
+        care.append((pos, pos + chunk_sz))
+      elif chunk_type == CHUNK_TYPE_FILL:
+        fill = self.f.read(4) * (blk_sz / 4)
+        self.chunks.append((pos, pos + chunk_sz, None, fill))
+        care.append((pos, pos + chunk_sz))
+      elif chunk_type not in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+        raise common.ExternalError("%s: unknown chunk type 0x%04x"
+                                   % (self.path, chunk_type))
+      self.f.seek(data_start + data_sz)
+      pos += chunk_sz
+    if pos != total_blks:
+      raise common.ExternalError("%s: chunks cover %d blocks, not %d"
+                                 % (self.path, pos, total_blks))
+    self.care_map = RangeSet(care)
+
+  def ReadBlocks(self, start, count):
+    """Return the contents of count blocks from block start on."""
+    bs = self.block_size
+    chunks = self.chunks
+    end = start + count
+    pos = start
+    # the last chunk starting at or before pos, if any
+    i = bisect.bisect_right(self.chunk_starts, start) - 1
+    out = []
+    self.lock.acquire()
+    try:
+      while pos < end:
+        if i >= 0 and pos < chunks[i][1]:
+          chunk_start, chunk_end, offset, fill = chunks[i]
+          n = min(end, chunk_end) - pos
+          if offset is None:
+            out.append(fill * n)
+          else:
+            self.f.seek(offset + (pos - chunk_start) * bs)
+            out.append(self.f.read(n * bs))
+        else:
+          if i + 1 < len(chunks):
+            n = min(end, chunks[i+1][0]) - pos
+          else:
+            n = end - pos
+          out.append("\0" * (n * bs))
+        pos += n
+        if i + 1 < len(chunks) and pos >= chunks[i+1][0]:
+          i += 1
+    finally:
+      self.lock.release()
+    return "".join(out)
+
+  def ReadRanges(self, ranges):
+    """Generate the contents of the blocks in the RangeSet ranges, in
+    order, a few blocks at a time."""
+    for start, end in ranges:
+      while start < end:
+        n = min(end - start, READ_BLOCKS)
+        yield self.ReadBlocks(start, n)
+        start += n
+
+  def HashBlocks(self):
+    """Return ({block number: sha1 digest} for each block in the care
+    map, hex sha1 of all of them in order)."""
+    bs = self.block_size
+    hashes = {}
+    total = sha1()
+    for start, end in self.care_map:
+      for b in range(start, end, READ_BLOCKS):
+        data = self.ReadBlocks(b, min(end - b, READ_BLOCKS))
+        total.update(data)
+        for i in range(0, len(data), bs):
+          hashes[b + i / bs] = sha1(data[i:i+bs]).digest()
+    return hashes, total.hexdigest()
+
+
+class RangeFile(common.LazyFile):
+  """A LazyFile holding the contents of some blocks of an Image, so
+  they can be diffed with common.Difference like any other file."""
+
+  def __init__(self, name, image, ranges):
+    self.name = name
+    self.image = image
+    self.ranges = ranges
+    self.zip = None
+    self.zip_name = None
+    self.path = None
+    self.size = ranges.size * image.block_size
+    self.crc = None
+    self._sha1 = None
+
+  def Chunks(self):
+    return self.image.ReadRanges(self.ranges)
+
+
+class Transfer(object):
+  def __init__(self, style, tgt_ranges, src_ranges=None):
+    self.style = style
+    self.tgt_ranges = tgt_ranges
+    self.src_ranges = src_ranges
+    self.diff = None
+
+
+class BlockImageDiff(object):
+  """Computes the transfers that turn the source Image into the target
+  one.  Call Compute(), then WriteToZip()."""
+
+  def __init__(self, tgt, src, name, threshold=0.95):
+    if tgt.block_size != src.block_size:
+      raise common.ExternalError("source and target block sizes differ "
+                                 "(%d, %d)" % (src.block_size,
+                                               tgt.block_size))
+    self.tgt = tgt
+    self.src = src
+    self.name = name
+    self.threshold = threshold
+    self.transfers = []
+
+  def Compute(self):
+    self.FindTransfers()
+    self.ComputePatches()
+    self.OrderTransfers()
+
+  def FindTransfers(self):
+    """Classify each changed target block, and group them into
+    transfers."""
+    src_result = []
+    def hash_source():
+      src_result.append(self.src.HashBlocks())
+    th = threading.Thread(target=hash_source)
+    th.start()
+    tgt_hashes, self.tgt_sha1 = self.tgt.HashBlocks()
+    th.join()
+    src_hashes, self.src_sha1 = src_result[0]
+
+    # digest -> lowest source block holding it
+    src_index = {}
+    for b in sorted(src_hashes.keys(), reverse=True):
+      src_index[src_hashes[b]] = b
+
+    zero = sha1("\0" * self.tgt.block_size).digest()
+    zeros = []
+    changed = []
+    moves = []      # [tgt start, src start, length]
+    unchanged = 0
+    for b in sorted(tgt_hashes.keys()):
+      h = tgt_hashes[b]
+      if src_hashes.get(b) == h:
+        unchanged += 1
+      elif h == zero:
+        zeros.append(b)
+      elif h in src_index:
+        # Prefer extending the previous move, so runs of moved blocks
+        # become a single transfer.
+        if moves:
+          t, s, n = moves[-1]
+          if t + n == b and src_hashes.get(s + n) == h:
+            moves[-1][2] += 1
+            continue
+        moves.append([b, src_index[h], 1])
+      else:
+        changed.append(b)
+
+    self.transfers = []
+    if zeros:
+      self.transfers.append(Transfer("zero", RangeSet.FromBlocks(zeros)))
+    for t, s, n in moves:
+      self.transfers.append(Transfer("move", RangeSet([(t, t + n)]),
+                                     RangeSet([(s, s + n)])))
+    for i in range(0, len(changed), MAX_PATCH_BLOCKS):
+      tgt_ranges = RangeSet.FromBlocks(changed[i:i+MAX_PATCH_BLOCKS])
+      src_ranges = tgt_ranges.Intersect(self.src.care_map)
+      if src_ranges:
+        self.transfers.append(Transfer("bsdiff", tgt_ranges, src_ranges))
+      else:
+        self.transfers.append(Transfer("new", tgt_ranges))
+    self.transfers.sort(key=lambda xf: xf.tgt_ranges.ranges[0])
+
+    print "%s: %d blocks unchanged, %d moved, %d zero, %d changed" % (
+        self.name, unchanged, sum([m[2] for m in moves]), len(zeros),
+        len(changed))
+
+  def ComputePatches(self):
+    """Diff each bsdiff transfer's source and target blocks (in the
+    common.ComputeDifferences worker pool), and send the target blocks
+    as new data instead wherever the patch isn't worth it."""
+    diffs = []
+    for xf in self.transfers:
+      if xf.style != "bsdiff":
+        continue
+      label = "%s blocks %d-%d" % (self.name, xf.tgt_ranges.ranges[0][0],
+                                   xf.tgt_ranges.ranges[-1][1] - 1)
+      xf.diff = common.Difference(
+          RangeFile(label, self.tgt, xf.tgt_ranges),
+          RangeFile(label, self.src, xf.src_ranges), "bsdiff")
+      diffs.append(xf.diff)
+    common.ComputeDifferences(diffs)
+
+    for xf in self.transfers:
+      if xf.style != "bsdiff":
+        continue
+      tf, _, patch = xf.diff.GetPatch()
+      if patch is None or len(patch) > tf.size * self.threshold:
+        self._MakeNew(xf)
+
+  def _MakeNew(self, xf):
+    xf.style = "new"
+    xf.src_ranges = None
+    xf.diff = None
+
+  def OrderTransfers(self):
+    """Order the transfers so that none of them overwrites blocks that
+    a later one still has to read.  Where transfers depend on each
+    other in a cycle, one of them is turned into new data, which reads
+    nothing."""
+    xfs = self.transfers
+    writes = []
+    for i, xf in enumerate(xfs):
+      for start, end in xf.tgt_ranges:
+        writes.append((start, end, i))
+    writes.sort()
+    write_starts = [w[0] for w in writes]
+
+    # then[i]: the transfers that overwrite blocks transfer i reads,
+    # and so must wait for it.  waiting[j]: how many transfers j is
+    # waiting for.
+    then = [set() for xf in xfs]
+    waiting = [0] * len(xfs)
+    for i, xf in enumerate(xfs):
+      if xf.src_ranges is None:
+        continue
+      for start, end in xf.src_ranges:
+        k = max(bisect.bisect_right(write_starts, start) - 1, 0)
+        while k < len(writes) and writes[k][0] < end:
+          _, w_end, j = writes[k]
+          if w_end > start and j != i and j not in then[i]:
+            then[i].add(j)
+            waiting[j] += 1
+          k += 1
+
+    def release(i):
+      for j in then[i]:
+        waiting[j] -= 1
+        if waiting[j] == 0:
+          heapq.heappush(ready, j)
+      then[i] = set()
+
+    # Otherwise keep the transfers in block order.
+    ready = [i for i in range(len(xfs)) if waiting[i] == 0]
+    heapq.heapify(ready)
+    done = [False] * len(xfs)
+    order = []
+    broken = 0
+    while len(order) < len(xfs):
+      if not ready:
+        i = min([i for i in range(len(xfs)) if not done[i] and then[i]],
+                key=lambda i: xfs[i].tgt_ranges.size)
+        self._MakeNew(xfs[i])
+        release(i)
+        broken += 1
+        continue
+      i = heapq.heappop(ready)
+      done[i] = True
+      order.append(xfs[i])
+      release(i)
+    if broken:
+      print "%s: %d transfers sent as new data to break cycles" % (
+          self.name, broken)
+    self.transfers = order
+
+  def NewData(self):
+    """Generate the contents of the new data file."""
+    for xf in self.transfers:
+      if xf.style == "new":
+        for data in self.tgt.ReadRanges(xf.tgt_ranges):
+          yield data
+
+  def WriteToZip(self, output_zip, prefix):
+    """Write the transfer list, new data and patch data to output_zip
+    as prefix.transfer.list, prefix.new.dat and prefix.patch.dat."""
+    lines = []
+    patches = []
+    total = 0
+    offset = 0
+    new_blocks = 0
+    for xf in self.transfers:
+      tgt = xf.tgt_ranges.ToRaw()
+      total += xf.tgt_ranges.size
+      if xf.style == "bsdiff":
+        _, _, patch = xf.diff.GetPatch()
+        lines.append("bsdiff %d %d %s %s" % (
+            offset, len(patch), xf.src_ranges.ToRaw(), tgt))
+        patches.append(patch)
+        offset += len(patch)
+      elif xf.style == "move":
+        lines.append("move %s %s" % (xf.src_ranges.ToRaw(), tgt))
+      else:
+        if xf.style == "new":
+          new_blocks += xf.tgt_ranges.size
+        lines.append("%s %s" % (xf.style, tgt))
+
+    common.ZipWriteStr(output_zip, prefix + ".transfer.list",
+                       "\n".join(["1", str(total)] + lines) + "\n")
+    common.ZipWriteStream(output_zip, prefix + ".new.dat", self.NewData(),
+                          size=new_blocks * self.tgt.block_size)
+    # The updater reads the patches straight out of the package at the
+    # offsets in the transfer list, so they must not be compressed.
+    common.ZipWriteStream(output_zip, prefix + ".patch.dat", patches,
+                          size=offset, compress_type=zipfile.ZIP_STORED)
+    print "%s: %d transfers, %d new blocks, %d bytes of patches" % (
+        self.name, len(self.transfers), new_blocks, offset)
@@ -12,22 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import atexit
 import copy
 import errno
+import fcntl
+import fnmatch
 import getopt
 import getpass
 import imp
+import json
 import os
 import platform
+import Queue
 import re
 import shlex
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
 import threading
 import time
 import zipfile
+import zlib
 
 try:
   from hashlib import sha1 as sha1
@@ -51,6 +60,16 @@ OPTIONS.tempfiles = []
 OPTIONS.device_specific = None
 OPTIONS.extras = {}
 OPTIONS.info_dict = None
+OPTIONS.patch_cache = None
+OPTIONS.patch_journal = None
+OPTIONS.diff_cost_model = None
+OPTIONS.diff_memory_budget = None
+OPTIONS.unzip_threads = 4
+OPTIONS.extract_cache_dir = None
+OPTIONS.extract_cache_size = 20480   # megabytes
+OPTIONS.extract_cache_locks = {}
+OPTIONS.trace = None
+OPTIONS.zip_threads = 4
 
 
 # Values for "certificate" in apkcerts that mean special things.
@@ -62,12 +81,172 @@ class ExternalError(RuntimeError): pass
 
 def Run(args, **kwargs):
   """Create and return a subprocess.Popen object, printing the command
-  line on the terminal if -v was specified."""
+  line on the terminal if -v was specified.  If --trace was given the
+  child is recorded in the trace once it has been waited for."""
   if OPTIONS.verbose:
     print "  running: ", " ".join(args)
+  if OPTIONS.trace is not None:
+    return TracedPopen(args, **kwargs)
   return subprocess.Popen(args, **kwargs)
 
 
+class Tracer(object):
+  """Collects timing events and writes them out in the Chrome
+  trace-event format (load the file in chrome://tracing).  Child
+  processes started with Run() appear as spans on the thread that
+  started them, annotated with their command line, CPU time, peak RSS
+  and exit status; TraceSpan adds spans for work done in Python."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.start = time.time()
+    self.events = []
+    self.threads = {}
+    self.lock = threading.Lock()
+
+  def _Tid(self):
+    # Called with self.lock held.
+    t = threading.currentThread()
+    tid = self.threads.get(t.ident)
+    if tid is None:
+      tid = self.threads[t.ident] = len(self.threads) + 1
+      self.events.append({"name": "thread_name", "ph": "M",
+                          "pid": os.getpid(), "tid": tid,
+                          "args": {"name": t.getName()}})
+    return tid
+
+  def Add(self, name, cat, start, end, args):
+    """Record a span called 'name' from time 'start' to 'end' (as
+    returned by time.time()) on the current thread."""
+    self.lock.acquire()
+    try:
+      self.events.append({"name": name, "cat": cat, "ph": "X",
+                          "ts": int((start - self.start) * 1e6),
+                          "dur": int((end - start) * 1e6),
+                          "pid": os.getpid(), "tid": self._Tid(),
+                          "args": args})
+    finally:
+      self.lock.release()
+
+  def Write(self):
+    self.lock.acquire()
+    try:
+      f = open(self.filename, "w")
+      try:
+        json.dump({"traceEvents": self.events,
+                   "displayTimeUnit": "ms"}, f)
+      finally:
+        f.close()
+    finally:
+      self.lock.release()
+
+
+class TraceSpan(object):
+  """Times a piece of Python-side work for the --trace output.  Use
+  as:
+
+    span = TraceSpan("name", key=value...)
+    try:
+      ...
+    finally:
+      span.End()
+
+  Does nothing when tracing isn't enabled."""
+
+  def __init__(self, name, **args):
+    self.name = name
+    self.args = args
+    self.start = time.time()
+
+  def End(self):
+    if OPTIONS.trace is not None:
+      OPTIONS.trace.Add(self.name, "python", self.start, time.time(),
+                        self.args)
+
+
+class TracedPopen(subprocess.Popen):
+  """A subprocess.Popen that records the child in OPTIONS.trace when
+  it is reaped, using wait4() to get its resource usage."""
+
+  def __init__(self, args, **kwargs):
+    self.trace_start = time.time()
+    subprocess.Popen.__init__(self, args, **kwargs)
+    self.trace_args = args
+
+  def Reaped(self, status, rusage):
+    """Record the exit status and resource usage of the child, as
+    returned by os.wait4()."""
+    self._handle_exitstatus(status)
+    args = self.trace_args
+    if isinstance(args, basestring):
+      args = [args]
+    OPTIONS.trace.Add(os.path.basename(args[0]), "process",
+                      self.trace_start, time.time(),
+                      {"argv": " ".join(args),
+                       "pid": self.pid,
+                       "user_sec": rusage.ru_utime,
+                       "sys_sec": rusage.ru_stime,
+                       "peak_rss_mb": PeakRss(rusage) / 1048576.0,
+                       "returncode": self.returncode})
+
+  def wait(self):
+    while self.returncode is None:
+      try:
+        _, status, rusage = os.wait4(self.pid, 0)
+      except OSError, e:
+        if e.errno != errno.EINTR:
+          raise
+        continue
+      self.Reaped(status, rusage)
+    return self.returncode
+
+  def poll(self):
+    if self.returncode is None:
+      try:
+        pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+      except OSError:
+        return None
+      if pid == self.pid:
+        self.Reaped(status, rusage)
+    return self.returncode
+
+
+def Communicate(p):
+  """Wait for the process p (started by Run() without a stdin pipe) to
+  finish, like p.communicate(), but also collect its resource usage.
+  Returns (stdout, stderr, rusage), where rusage is the child's
+  resource.struct_rusage."""
+  output = {}
+  def drain(name, pipe):
+    output[name] = pipe.read()
+    pipe.close()
+  readers = []
+  for name in ("stdout", "stderr"):
+    pipe = getattr(p, name)
+    if pipe is not None:
+      t = threading.Thread(target=drain, args=(name, pipe))
+      t.start()
+      readers.append(t)
+  for t in readers:
+    t.join()
+
+  _, status, rusage = os.wait4(p.pid, 0)
+  if isinstance(p, TracedPopen):
+    p.Reaped(status, rusage)
+  elif os.WIFSIGNALED(status):
+    p.returncode = -os.WTERMSIG(status)
+  else:
+    p.returncode = os.WEXITSTATUS(status)
+  return output.get("stdout"), output.get("stderr"), rusage
+
+
+def PeakRss(rusage):
+  """Return the peak resident set size, in bytes, from a rusage."""
+  if platform.system() == "Darwin":
+    return rusage.ru_maxrss
+  return rusage.ru_maxrss * 1024
+
+
 def CloseInheritedPipes():
   """ Gmake in MAC OS has file descriptor (PIPE) leak. We close those fds
   before doing other work."""
@@ -84,6 +263,50 @@ def CloseInheritedPipes():
       pass
 
 
+def RunInParallel(func, items, threads):
+  """Call func on each element of the iterable items, from up to
+  'threads' threads at once.  Items are taken from the iterable in
+  order, one at a time under a lock, so it may be a generator.  Once a
+  call (or the iterable) raises an exception, no more items are
+  started; when the calls in progress have finished, the first
+  exception is re-raised."""
+  lock = threading.Lock()
+  item_iter = iter(items)   # accessed under lock
+  errors = []
+
+  def worker():
+    while True:
+      lock.acquire()
+      try:
+        if errors: return
+        try:
+          item = item_iter.next()
+        except StopIteration:
+          return
+        except:
+          errors.append(sys.exc_info())
+          return
+      finally:
+        lock.release()
+      try:
+        func(item)
+      except:
+        lock.acquire()
+        errors.append(sys.exc_info())
+        lock.release()
+
+  if hasattr(items, "__len__"):
+    threads = min(threads, len(items))
+  threads = [threading.Thread(target=worker) for i in range(max(1, threads))]
+  for th in threads:
+    th.start()
+  while threads:
+    threads.pop().join()
+
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+
+
 def LoadInfoDict(zip):
   """Read and parse the META/misc_info.txt key/value pairs from the
   input target files and return a dict."""
@@ -258,6 +481,137 @@ def DumpInfoDict(d):
   for k, v in sorted(d.items()):
     print "%-25s = (%s) %s" % (k, type(v).__name__, v)
 
+class RamdiskCpio(object):
+  """Builds the newc cpio archive of a ramdisk directory exactly as
+  'mkbootfs [-f <fs_config_file>]' would: entries in strcmp order,
+  dotfiles and entries named "root" skipped, zero mtimes, inodes
+  numbered from 300000, and permissions taken from fs_config, which
+  is either a canned config (as parsed by ParseFilesystemConfig) or
+  an FsConfigTable of the default rules.  Like mkbootfs, it writes 0
+  for every uid and gid; the ones in fs_config are ignored."""
+
+  def __init__(self, fs_config):
+    self.fs_config = fs_config
+    self.out = []
+    self.total_size = 0
+    self.next_inode = 300000
+
+  def _Pad(self, alignment):
+    n = -self.total_size % alignment
+    if n:
+      self.out.append("\0" * n)
+      self.total_size += n
+
+  def _FixStat(self, path, mode):
+    if isinstance(self.fs_config, FsConfigTable):
+      uid, gid, perms = self.fs_config.Lookup(path, stat.S_ISDIR(mode))
+      return uid, gid, perms | (mode & ~07777)
+    c = self.fs_config.get(path)
+    if c is None:
+      c = self.fs_config.get("")
+      if c is None:
+        raise ExternalError("no fs_config entry for ramdisk path \"%s\"" %
+                            (path,))
+    uid, gid, perms = c
+    return uid, gid, perms | (mode & ~07777)
+
+  def _Eject(self, mode, name, data):
+    self._Pad(4)
+    _, _, mode = self._FixStat(name, mode)
+    self.out.append("%06x%08x%08x%08x%08x%08x%08x"
+                    "%08x%08x%08x%08x%08x%08x%08x%s\0" % (
+        0x070701, self.next_inode, mode, 0, 0, 1, 0,
+        len(data), 0, 0, 0, 0, len(name) + 1, 0, name))
+    self.next_inode += 1
+    self.total_size += 6 + 8*13 + len(name) + 1
+    self._Pad(4)
+    if data:
+      self.out.append(data)
+      self.total_size += len(data)
+
+  def _Archive(self, path, name):
+    st = os.lstat(path)
+    if stat.S_ISREG(st.st_mode):
+      f = open(path, "rb")
+      try:
+        self._Eject(st.st_mode, name, f.read())
+      finally:
+        f.close()
+    elif stat.S_ISDIR(st.st_mode):
+      self._Eject(st.st_mode, name, "")
+      self._ArchiveDir(path, name)
+    elif stat.S_ISLNK(st.st_mode):
+      self._Eject(st.st_mode, name, os.readlink(path))
+    else:
+      raise ExternalError("can't pack \"%s\" (mode 0%o) into ramdisk" %
+                          (path, st.st_mode))
+
+  def _ArchiveDir(self, path, name):
+    for fn in sorted(os.listdir(path)):
+      if fn.startswith(".") or fn == "root": continue
+      if name:
+        self._Archive(os.path.join(path, fn), name + "/" + fn)
+      else:
+        self._Archive(os.path.join(path, fn), fn)
+
+  def Build(self, ramdisk_dir):
+    """Return the archive of ramdisk_dir as a string."""
+    self._ArchiveDir(ramdisk_dir, "")
+    self._Eject(0, "TRAILER!!!", "")
+    self._Pad(256)
+    return "".join(self.out)
+
+
+def MiniGzip(data):
+  """Return data compressed exactly as the minigzip tool does it (zlib
+  gzip stream, level 6, no name or timestamp in the header)."""
+  c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+  return c.compress(data) + c.flush()
+
+
+# sha1 of uncompressed ramdisk archive -> compressed ramdisk
+ramdisk_cache = {}
+# (ramdisk dir, fs_config file) -> compressed ramdisk.  The unpacked
+# target-files trees aren't modified once extracted, so a directory
+# only needs to be archived once.
+ramdisk_dir_cache = {}
+
+def BuildRamdisk(ramdisk_dir, fs_config_file):
+  """Return the gzipped cpio archive of ramdisk_dir, byte-identical
+  to 'mkbootfs | minigzip'.  The archive is built in-process, using
+  the canned fs_config_file if there is one and the FsConfigTable of
+  mkbootfs's compiled-in rules otherwise; mkbootfs itself is only run
+  with host tools that predate the table.  Each directory is only
+  archived once, and identical archives are only compressed once."""
+  dir_key = (os.path.realpath(ramdisk_dir), fs_config_file)
+  data = ramdisk_dir_cache.get(dir_key)
+  if data is not None:
+    return data
+
+  if os.access(fs_config_file, os.F_OK):
+    f = open(fs_config_file)
+    try:
+      fs_config = ParseFilesystemConfig(f.read())
+    finally:
+      f.close()
+  else:
+    fs_config = LoadFsConfigTable()
+  if fs_config is not None:
+    cpio = RamdiskCpio(fs_config).Build(ramdisk_dir)
+  else:
+    p = Run(["mkbootfs", ramdisk_dir], stdout=subprocess.PIPE)
+    cpio, _ = p.communicate()
+    if p.returncode != 0:
+      raise ExternalError("mkbootfs of %s failed" % (ramdisk_dir,))
+
+  key = sha1(cpio).hexdigest()
+  data = ramdisk_cache.get(key)
+  if data is None:
+    data = ramdisk_cache[key] = MiniGzip(cpio)
+  ramdisk_dir_cache[dir_key] = data
+  return data
+
+
 def BuildBootableImage(sourcedir, fs_config_file, info_dict=None):
   """Take a kernel, cmdline, and ramdisk directory from the input (in
   'sourcedir'), and turn them into a boot image.  Return the image
@@ -271,21 +625,13 @@ def BuildBootableImage(sourcedir, fs_config_file, info_dict=None):
   if info_dict is None:
     info_dict = OPTIONS.info_dict
 
+  span = TraceSpan("BuildBootableImage", sourcedir=sourcedir)
   ramdisk_img = tempfile.NamedTemporaryFile()
   img = tempfile.NamedTemporaryFile()
 
-  if os.access(fs_config_file, os.F_OK):
-    cmd = ["mkbootfs", "-f", fs_config_file, os.path.join(sourcedir, "RAMDISK")]
-  else:
-    cmd = ["mkbootfs", os.path.join(sourcedir, "RAMDISK")]
-  p1 = Run(cmd, stdout=subprocess.PIPE)
-  p2 = Run(["minigzip"],
-           stdin=p1.stdout, stdout=ramdisk_img.file.fileno())
-
-  p2.wait()
-  p1.wait()
-  assert p1.returncode == 0, "mkbootfs of %s ramdisk failed" % (targetname,)
-  assert p2.returncode == 0, "minigzip of %s ramdisk failed" % (targetname,)
+  ramdisk_img.write(BuildRamdisk(os.path.join(sourcedir, "RAMDISK"),
+                                 fs_config_file))
+  ramdisk_img.flush()
 
   """check if uboot is requested"""
   fn = os.path.join(sourcedir, "ubootargs")
@@ -332,6 +678,7 @@ def BuildBootableImage(sourcedir, fs_config_file, info_dict=None):
 
   ramdisk_img.close()
   img.close()
+  span.End()
 
   return data
 
@@ -361,38 +708,322 @@ def GetBootableImage(name, prebuilt_name, unpack_dir, tree_subdir,
                                          info_dict))
 
 
-def UnzipTemp(filename, pattern=None):
+def UnzipTemp(filename, pattern=None, exclude=None):
   """Unzip the given archive into a temporary directory and return the name.
 
   If filename is of the form "foo.zip+bar.zip", unzip foo.zip into a
   temp dir, then unzip bar.zip into that_dir/BOOTABLE_IMAGES.
 
+  pattern and exclude are each None, a single fnmatch-style pattern,
+  or a list of them; only the entries of the main archive that match
+  some pattern (all of them, if pattern is None) and no exclude
+  pattern are extracted.  bar.zip is always extracted in full.
+
+  If OPTIONS.extract_cache_dir is set, the directory returned is a
+  shared one in the extraction cache (see UnzipCached) rather than a
+  fresh temp dir, and callers must not modify the files in it.
+
   Returns (tempdir, zipobj) where zipobj is a zipfile.ZipFile (of the
   main file), open for reading.
   """
 
-  tmp = tempfile.mkdtemp(prefix="targetfiles-")
-  OPTIONS.tempfiles.append(tmp)
+  span = TraceSpan("UnzipTemp", filename=filename)
+  try:
+    images_zip = None
+    m = re.match(r"^(.*[.]zip)\+(.*[.]zip)$", filename, re.IGNORECASE)
+    if m:
+      filename = m.group(1)
+      images_zip = OpenZip(m.group(2))
+    input_zip = OpenZip(filename)
+
+    if OPTIONS.extract_cache_dir:
+      tmp = UnzipCached(input_zip, images_zip, pattern, exclude)
+    else:
+      tmp = tempfile.mkdtemp(prefix="targetfiles-")
+      OPTIONS.tempfiles.append(tmp)
+      if images_zip is not None:
+        UnzipToDir(images_zip, os.path.join(tmp, "BOOTABLE_IMAGES"))
+      UnzipToDir(input_zip, tmp, pattern, exclude)
+
+    if images_zip is not None:
+      images_zip.close()
+    return tmp, input_zip
+  finally:
+    span.End()
+
+
+def ReleaseUnzipTemp(tmp):
+  """Remove a directory returned by UnzipTemp, or just stop holding it
+  in use if it's in the extraction cache, without waiting for
+  Cleanup()."""
+  lock = OPTIONS.extract_cache_locks.pop(tmp, None)
+  if lock is not None:
+    lock.close()
+    return
+  if tmp in OPTIONS.tempfiles:
+    OPTIONS.tempfiles.remove(tmp)
+  shutil.rmtree(tmp)
+
+
+def ZipKey(input_zip):
+  """Return a digest identifying the contents of the zipfile.ZipFile
+  input_zip, computed from its central directory (names, CRCs, sizes
+  and modes of the entries) rather than from all of its data."""
+  h = sha1()
+  for info in input_zip.infolist():
+    h.update("%s\0%08x %d %d %x\n" % (info.filename, info.CRC & 0xffffffff,
+                                      info.file_size, info.compress_size,
+                                      info.external_attr))
+  return h.hexdigest()
+
+
+def _LockCacheEntry(lock_name, operation):
+  """Open and flock() the named lock file, retrying if the file is
+  deleted (by TrimExtractCache) while we wait for the lock.  Returns
+  the open file, or None if operation includes LOCK_NB and the lock
+  is held elsewhere."""
+  while True:
+    f = open(lock_name, "a")
+    try:
+      fcntl.flock(f.fileno(), operation)
+    except IOError, e:
+      f.close()
+      if e.errno in (errno.EAGAIN, errno.EACCES):
+        return None
+      raise
+    if _IsCurrentLock(f):
+      return f
+    f.close()
+
 
-  def unzip_to_dir(filename, dirname):
-    cmd = ["unzip", "-o", "-q", filename, "-d", dirname]
-    if pattern is not None:
-      cmd.append(pattern)
-    p = Run(cmd, stdout=subprocess.PIPE)
-    p.communicate()
-    if p.returncode != 0:
-      raise ExternalError("failed to unzip input target-files \"%s\"" %
-                          (filename,))
-
-  m = re.match(r"^(.*[.]zip)\+(.*[.]zip)$", filename, re.IGNORECASE)
-  if m:
-    unzip_to_dir(m.group(1), tmp)
-    unzip_to_dir(m.group(2), os.path.join(tmp, "BOOTABLE_IMAGES"))
-    filename = m.group(1)
-  else:
-    unzip_to_dir(filename, tmp)
+def _IsCurrentLock(f):
+  """Return true if the open lock file f has not been deleted."""
+  try:
+    return os.fstat(f.fileno()).st_ino == os.stat(f.name).st_ino
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+    return False
+
+
+def UnzipCached(input_zip, images_zip=None, pattern=None, exclude=None):
+  """Make sure the selected entries of input_zip (and all of
+  images_zip, under BOOTABLE_IMAGES/) are extracted into the
+  directory for this archive in OPTIONS.extract_cache_dir, and return
+  that directory.
 
-  return tmp, zipfile.ZipFile(filename, "r")
+  Each archive's directory is paired with a lock file and a manifest
+  of the entries extracted so far ("size name" lines), so a later
+  caller wanting more entries only extracts the missing ones.  Entries
+  are extracted under an exclusive lock; afterwards a shared lock is
+  kept until Cleanup(), which stops TrimExtractCache from evicting a
+  directory that is still in use."""
+
+  cache_dir = OPTIONS.extract_cache_dir
+  try:
+    os.makedirs(cache_dir)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+
+  key = ZipKey(input_zip)
+  wanted = [("", input_zip, ZipEntries(input_zip, pattern, exclude))]
+  if images_zip is not None:
+    key = sha1(key + ZipKey(images_zip)).hexdigest()
+    wanted.append(("BOOTABLE_IMAGES/", images_zip, images_zip.infolist()))
+  path = os.path.join(cache_dir, key)
+  manifest_name = path + ".entries"
+
+  # flock() locks belong to the open file, so if this process is
+  # already using the directory, upgrade the lock it holds rather
+  # than waiting on itself.
+  lock = OPTIONS.extract_cache_locks.pop(path, None)
+  if lock is not None:
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    if not _IsCurrentLock(lock):
+      lock.close()
+      lock = None
+  if lock is None:
+    lock = _LockCacheEntry(path + ".lock", fcntl.LOCK_EX)
+  try:
+    present = set()
+    if os.path.exists(manifest_name):
+      f = open(manifest_name)
+      for line in f:
+        present.add(line.rstrip("\n").split(" ", 1)[1])
+      f.close()
+
+    added = []
+    for prefix, z, entries in wanted:
+      missing = [i for i in entries if prefix + i.filename not in present]
+      if not missing: continue
+      print "extracting %d entries of %s into %s..." % (
+          len(missing), z.filename, path)
+      ExtractEntries(z, missing, os.path.join(path, prefix))
+      added.extend([(i.file_size, prefix + i.filename) for i in missing])
+
+    if added:
+      f = open(manifest_name, "a")
+      for size, name in added:
+        f.write("%d %s\n" % (size, name))
+      f.close()
+    else:
+      print "using cached extraction of %s in %s" % (input_zip.filename, path)
+    os.utime(lock.name, None)
+  except:
+    lock.close()
+    raise
+
+  # Keep a shared lock while this directory is in use.
+  fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+  OPTIONS.extract_cache_locks[path] = lock
+  return path
+
+
+def ExtractCacheEntries(cache_dir):
+  """Return a list of (last use time, size in bytes, path) for the
+  extracted archives in the cache directory cache_dir, least recently
+  used first."""
+  entries = []
+  if not os.path.isdir(cache_dir): return entries
+  for fn in os.listdir(cache_dir):
+    if not fn.endswith(".entries"): continue
+    path = os.path.join(cache_dir, fn[:-len(".entries")])
+    size = 0
+    try:
+      f = open(path + ".entries")
+      for line in f:
+        size += int(line.split(" ", 1)[0])
+      f.close()
+      mtime = os.stat(path + ".lock").st_mtime
+    except (IOError, OSError):
+      continue
+    entries.append((mtime, size, path))
+  entries.sort()
+  return entries
+
+
+def ExtractCacheEntryInUse(path):
+  """Return true if the extracted archive at path (as returned by
+  ExtractCacheEntries) is in use by any process."""
+  lock = _LockCacheEntry(path + ".lock", fcntl.LOCK_EX | fcntl.LOCK_NB)
+  if lock is None:
+    return True
+  lock.close()
+  return False
+
+
+def TrimExtractCache(cache_dir, max_size):
+  """Delete the least recently used archives from the extraction
+  cache until its total size is no more than max_size bytes.  Archives
+  that are in use by any process are left alone, so a max_size of 0
+  removes everything not in use."""
+  entries = ExtractCacheEntries(cache_dir)
+  total = sum([size for _, size, _ in entries])
+  for _, size, path in entries:
+    if total <= max_size: break
+    lock = _LockCacheEntry(path + ".lock", fcntl.LOCK_EX | fcntl.LOCK_NB)
+    if lock is None:
+      continue   # in use
+    try:
+      print "removing cached extraction %s" % (path,)
+      os.remove(path + ".entries")
+      shutil.rmtree(path, ignore_errors=True)
+      os.remove(path + ".lock")
+    finally:
+      lock.close()
+    total -= size
+
+
+def OpenZip(filename):
+  """Open the named zip file for reading, raising ExternalError if it
+  can't be."""
+  try:
+    return zipfile.ZipFile(filename, "r")
+  except (IOError, zipfile.BadZipfile), e:
+    raise ExternalError("failed to open input target-files \"%s\": %s" %
+                        (filename, e))
+
+
+def _MatchesAny(name, patterns):
+  if isinstance(patterns, basestring):
+    patterns = [patterns]
+  for p in patterns:
+    if fnmatch.fnmatchcase(name, p):
+      return True
+  return False
+
+
+def ZipEntries(input_zip, pattern=None, exclude=None):
+  """Return the ZipInfos of input_zip that match pattern and not
+  exclude (see UnzipTemp), skipping any that would be extracted
+  outside the destination directory."""
+  entries = []
+  for info in input_zip.infolist():
+    fn = info.filename
+    if fn.startswith("/") or ".." in fn.split("/"):
+      print "skipping unsafe entry \"%s\"" % (fn,)
+      continue
+    if pattern is not None and not _MatchesAny(fn, pattern):
+      continue
+    if exclude is not None and _MatchesAny(fn, exclude):
+      continue
+    entries.append(info)
+  return entries
+
+
+def UnzipToDir(input_zip, dirname, pattern=None, exclude=None):
+  """Extract the entries of the zipfile.ZipFile input_zip that match
+  pattern and not exclude (see UnzipTemp) into dirname."""
+  ExtractEntries(input_zip, ZipEntries(input_zip, pattern, exclude), dirname)
+
+
+def ExtractEntries(input_zip, entries, dirname):
+  """Extract the given ZipInfos of input_zip into dirname, using
+  OPTIONS.unzip_threads threads.  Like 'unzip', restores the unix
+  permissions and timestamps of the entries and recreates symlinks."""
+
+  def make_dirs(path):
+    try:
+      os.makedirs(path)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def extract(info):
+    path = os.path.join(dirname, info.filename)
+    mode = info.external_attr >> 16
+    if info.filename.endswith("/"):
+      make_dirs(path)
+      return
+    make_dirs(os.path.dirname(path))
+    if os.path.lexists(path):
+      os.remove(path)
+    if IsSymlink(info):
+      os.symlink(input_zip.read(info.filename), path)
+      return
+    src = input_zip.open(info)
+    dst = open(path, "wb")
+    try:
+      shutil.copyfileobj(src, dst, FILE_CHUNK_SIZE)
+    finally:
+      dst.close()
+      src.close()
+    if info.create_system == 3 and mode & 07777:
+      os.chmod(path, mode & 07777)
+    t = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(path, (t, t))
+
+  def extract_or_report(info):
+    # Report failures to read or write the files as such; anything
+    # else (eg, a MemoryError) is passed on as it is.
+    try:
+      extract(info)
+    except (IOError, OSError, zipfile.BadZipfile, zlib.error), e:
+      raise ExternalError("failed to unzip input target-files \"%s\":\n"
+                          "  %s: %s" % (input_zip.filename, info.filename, e))
+
+  RunInParallel(extract_or_report, entries, OPTIONS.unzip_threads)
 
 
 def GetKeyPasswords(keylist):
@@ -469,12 +1100,7 @@ def SignFile(input_name, output_name, key, password, align=None,
 
   cmd = [OPTIONS.java_path, "-Xmx2048m", "-jar",
          os.path.join(OPTIONS.search_path, OPTIONS.signapk_path)]
-  cmd.extend(OPTIONS.extra_signapk_args)
-  if whole_file:
-    cmd.append("-w")
-  cmd.extend([key + OPTIONS.public_key_suffix,
-              key + OPTIONS.private_key_suffix,
-              input_name, sign_name])
+  cmd.extend(SignApkArgs(input_name, sign_name, key, whole_file))
 
   p = Run(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
   if password is not None:
@@ -484,17 +1110,156 @@ def SignFile(input_name, output_name, key, password, align=None,
     raise ExternalError("signapk.jar failed: return code %s" % (p.returncode,))
 
   if align:
-    p = Run(["zipalign", "-f", str(align), sign_name, output_name])
-    p.communicate()
-    if p.returncode != 0:
-      raise ExternalError("zipalign failed: return code %s" % (p.returncode,))
+    ZipAlign(sign_name, output_name, align)
     temp.close()
 
 
+def SignApkArgs(input_name, output_name, key, whole_file=False):
+  """Return the signapk.jar arguments for signing input_name with key
+  to produce output_name."""
+  args = list(OPTIONS.extra_signapk_args)
+  if whole_file:
+    args.append("-w")
+  args.extend([key + OPTIONS.public_key_suffix,
+               key + OPTIONS.private_key_suffix,
+               input_name, output_name])
+  return args
+
+
+def ZipAlign(input_name, output_name, align):
+  """Run zipalign to align stored files in input_name on 'align'-byte
+  boundaries, producing output_name."""
+  p = Run(["zipalign", "-f", str(align), input_name, output_name])
+  p.communicate()
+  if p.returncode != 0:
+    raise ExternalError("zipalign failed: return code %s" % (p.returncode,))
+
+
+class BatchSigner(object):
+  """A long-lived 'signapk.jar --batch' process, which signs files one
+  after another so that signing many files doesn't pay for starting a
+  JVM each time.  Not thread-safe; use one per thread."""
+
+  def __init__(self):
+    self.p = None
+
+  def Sign(self, input_name, output_name, key, password, align=None,
+           whole_file=False):
+    """Sign input_name with key, like SignFile().  Returns None on
+    success, or a string describing the failure."""
+    if align == 0 or align == 1:
+      align = None
+    if align:
+      temp = tempfile.NamedTemporaryFile()
+      sign_name = temp.name
+    else:
+      sign_name = output_name
+
+    try:
+      error = self._Sign(SignApkArgs(input_name, sign_name, key, whole_file),
+                         password)
+      if error is None and align:
+        try:
+          ZipAlign(sign_name, output_name, align)
+        except ExternalError, e:
+          error = str(e)
+    finally:
+      if align:
+        temp.close()
+    return error
+
+  def _Sign(self, args, password):
+    if self.p is None:
+      cmd = [OPTIONS.java_path, "-Xmx2048m", "-jar",
+             os.path.join(OPTIONS.search_path, OPTIONS.signapk_path),
+             "--batch"]
+      # close_fds keeps other signers (started from other threads)
+      # from inheriting our stdin, which would stop Close() from
+      # ever delivering EOF.
+      self.p = Run(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                   close_fds=True)
+    if OPTIONS.verbose:
+      print "  signing: ", " ".join(args)
+    try:
+      self.p.stdin.write("\t".join(args) + "\n")
+      self.p.stdin.write((password or "") + "\n")
+      self.p.stdin.flush()
+      reply = self.p.stdout.readline()
+    except IOError:
+      reply = ""
+    if not reply:
+      self.Close()
+      return "signapk.jar exited unexpectedly"
+    reply = reply.rstrip("\n")
+    if reply == "OK":
+      return None
+    return "signapk.jar failed: " + reply
+
+  def Close(self):
+    if self.p is not None:
+      try:
+        self.p.stdin.close()
+      except IOError:
+        pass
+      self.p.wait()
+      self.p = None
+
+
+class BatchSignerPool(object):
+  """Signs files like BatchSigner, from any number of threads (such
+  as RunInParallel's): each calling thread gets a BatchSigner of its
+  own, and Close() closes them all."""
+
+  def __init__(self):
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.signers = []
+
+  def Sign(self, *args, **kwargs):
+    signer = getattr(self.local, "signer", None)
+    if signer is None:
+      signer = self.local.signer = BatchSigner()
+      self.lock.acquire()
+      self.signers.append(signer)
+      self.lock.release()
+    return signer.Sign(*args, **kwargs)
+
+  def Close(self):
+    for signer in self.signers:
+      signer.Close()
+
+
+def SignFiles(jobs, key_passwords, align=None, whole_file=False,
+              signers=2):
+  """Sign a list of (input_name, output_name, key) jobs, using up to
+  'signers' BatchSigner processes at once.  key_passwords is a {key:
+  password} dict, as returned by GetKeyPasswords().  align and
+  whole_file apply to every job, as for SignFile().
+
+  Returns a list, parallel to jobs, of None for each job that
+  succeeded or a string describing why it failed."""
+
+  results = [None] * len(jobs)
+  pool = BatchSignerPool()
+
+  def sign(job):
+    i, (input_name, output_name, key) = job
+    results[i] = pool.Sign(input_name, output_name, key,
+                           key_passwords.get(key), align=align,
+                           whole_file=whole_file)
+
+  try:
+    RunInParallel(sign, list(enumerate(jobs)), signers)
+  finally:
+    pool.Close()
+  return results
+
+
 def CheckSize(data, target, info_dict):
-  """Check the data string passed against the max size limit, if
-  any, for the given target.  Raise exception if the data is too big.
-  Print a warning if the data is nearing the maximum size."""
+  """Check the data string (or File object) passed against the max
+  size limit, if any, for the given target.  Raise exception if the
+  data is too big.  Print a warning if the data is nearing the maximum
+  size."""
 
   if target.endswith(".img"): target = target[:-4]
   mount_point = "/" + target
@@ -513,7 +1278,10 @@ def CheckSize(data, target, info_dict):
     # image size should be increased by 1/64th to account for the
     # spare area (64 bytes per 2k page)
     limit = limit / 2048 * (2048+64)
-  size = len(data)
+  if isinstance(data, File):
+    size = data.size
+  else:
+    size = len(data)
   pct = float(size) * 100.0 / limit
   msg = "%s size (%d) is %.2f%% of limit (%d)" % (target, size, pct, limit)
   if pct >= 99.0:
@@ -550,6 +1318,255 @@ def ReadApkCerts(tf_zip):
   return certmap
 
 
+def IsSymlink(info):
+  """Return true if the zipfile.ZipInfo object passed in represents a
+  symlink."""
+  return (info.external_attr >> 16) & 0770000 == 0120000
+
+
+class TargetFiles(object):
+  """A read-only view of a target-files zip, optionally backed by the
+  directory it was extracted into.
+
+  The central directory is indexed once by top-level directory
+  (SYSTEM, META, BOOT, ...), so callers interested in one part of the
+  archive don't have to scan all of it.  Entries are read from the
+  extracted copy when there is one, and from the zip otherwise.  The
+  info dict, apkcerts and filesystem_config are parsed at most once.
+
+  Supports the read-only parts of the zipfile.ZipFile interface
+  (read, open, getinfo, infolist, namelist), so it can be passed to
+  code (including device-specific extensions) expecting a ZipFile."""
+
+  def __init__(self, input_zip, input_tmp=None):
+    self.zip = input_zip
+    self.filename = input_zip.filename
+    self.input_tmp = input_tmp
+    self.entries = {}
+    self.by_dir = {}
+    self.all_entries = input_zip.infolist()
+    for info in self.all_entries:
+      self.entries[info.filename] = info
+      top = info.filename.split("/", 1)[0]
+      self.by_dir.setdefault(top, []).append(info)
+    self.info_dict = None
+    self.apk_certs = None
+    self.fs_config = {}
+
+  def __repr__(self):
+    return "<TargetFiles %s>" % (self.filename,)
+
+  def __contains__(self, name):
+    return name in self.entries
+
+  def infolist(self, top=None):
+    """Return the ZipInfos of the archive, in archive order.  If top
+    is given (eg "SYSTEM"), return only those under that top-level
+    directory."""
+    if top is None:
+      return self.all_entries
+    return self.by_dir.get(top, [])
+
+  def namelist(self, top=None):
+    return [i.filename for i in self.infolist(top)]
+
+  def getinfo(self, name):
+    return self.entries[name]
+
+  def LocalPath(self, name):
+    """Return the path of the extracted copy of the entry name, or
+    None if it wasn't extracted.  (Symlinks are never returned.)"""
+    if self.input_tmp is None:
+      return None
+    info = self.entries[name]
+    if name.endswith("/") or IsSymlink(info):
+      return None
+    path = os.path.join(self.input_tmp, name)
+    try:
+      st = os.lstat(path)
+    except OSError:
+      return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size != info.file_size:
+      return None
+    return path
+
+  def open(self, name):
+    path = self.LocalPath(name)
+    if path is not None:
+      return open(path, "rb")
+    return self.zip.open(name)
+
+  def read(self, name):
+    path = self.LocalPath(name)
+    if path is not None:
+      f = open(path, "rb")
+      try:
+        return f.read()
+      finally:
+        f.close()
+    return self.zip.read(name)
+
+  def close(self):
+    self.zip.close()
+
+  def LoadInfoDict(self):
+    """Return the (memoized) result of LoadInfoDict() on this
+    archive."""
+    if self.info_dict is None:
+      span = TraceSpan("LoadInfoDict", filename=self.filename)
+      try:
+        self.info_dict = LoadInfoDict(self)
+      finally:
+        span.End()
+    return self.info_dict
+
+  def ReadApkCerts(self):
+    """Return the (memoized) result of ReadApkCerts() on this
+    archive.  Callers must not modify the dict."""
+    if self.apk_certs is None:
+      self.apk_certs = ReadApkCerts(self)
+    return self.apk_certs
+
+  def LoadFilesystemConfig(self, name="META/filesystem_config.txt"):
+    """Parse the given filesystem_config file from the archive into a
+    {path: (uid, gid, mode)} dict, memoized.  Returns None if the
+    archive doesn't have it."""
+    if name not in self.fs_config:
+      try:
+        data = self.read(name)
+      except KeyError:
+        self.fs_config[name] = None
+      else:
+        self.fs_config[name] = ParseFilesystemConfig(data)
+    return self.fs_config[name]
+
+
+def ParseFilesystemConfig(data):
+  """Parse the output of fs_config (lines of "path uid gid mode") into
+  a {path: (uid, gid, mode)} dict.  The path may be empty (for the
+  root of the tree), and any fields after the mode are ignored."""
+  d = {}
+  for line in data.split("\n"):
+    if not line: continue
+    name, rest = line.split(" ", 1)
+    uid, gid, mode = rest.split()[:3]
+    d[name] = (int(uid), int(gid), int(mode, 8))
+  return d
+
+
+def RunFsConfig(paths):
+  """Return a {path: (uid, gid, mode)} dict for the given (path,
+  is_dir) pairs, as reported by one run of the 'fs_config' host
+  tool."""
+  suffix = { False: "", True: "/" }
+  p = Run(["fs_config"], stdin=subprocess.PIPE,
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  output, error = p.communicate(
+      "".join(["%s%s\n" % (name, suffix[dir]) for name, dir in paths]))
+  if error or p.returncode != 0:
+    raise ExternalError("fs_config failed:\n%s" % (error,))
+  return ParseFilesystemConfig(output)
+
+
+class FsConfigTable(object):
+  """The default ownership and permission rules compiled into the
+  fs_config host tool (and mkbootfs) from android_filesystem_config.h,
+  as printed by 'fs_config -t'.  Lookup() applies them the same way
+  the tool does."""
+
+  def __init__(self, data):
+    self.rules = { True: [], False: [] }
+    self.defaults = {}
+    for line in data.split("\n"):
+      if not line: continue
+      fields = line.split(" ", 4)
+      is_dir = { "dir": True, "file": False }[fields[0]]
+      meta = (int(fields[2]), int(fields[3]), int(fields[1], 8))
+      if len(fields) < 5:
+        self.defaults[is_dir] = meta
+      else:
+        self.rules[is_dir].append((fields[4], meta))
+
+  def Lookup(self, path, is_dir):
+    """Return the (uid, gid, mode) the rules give path."""
+    path = path.lstrip("/")
+    for prefix, meta in self.rules[is_dir]:
+      if is_dir:
+        # Directories match any rule that is a prefix of their path.
+        if path.startswith(prefix):
+          return meta
+      elif prefix.endswith("*"):
+        if path.startswith(prefix[:-1]):
+          return meta
+      elif path == prefix:
+        return meta
+    return self.defaults[is_dir]
+
+
+def LoadFsConfigTable():
+  """Return the FsConfigTable the build saves next to the fs_config
+  tool (as bin/fs_config.table under OPTIONS.search_path), or None if
+  these host tools predate it."""
+  try:
+    f = open(os.path.join(OPTIONS.search_path, "bin", "fs_config.table"))
+  except IOError:
+    return None
+  try:
+    return FsConfigTable(f.read())
+  finally:
+    f.close()
+
+
+class FsConfigIndex(object):
+  """The default (uid, gid, mode) of the paths of every build loaded
+  in this run.  Each distinct (path, is_dir) asked about gets an ID,
+  and its metadata is kept at that index of three compact arrays, so
+  the paths the source and target trees of an incremental share are
+  only looked up and stored once."""
+
+  def __init__(self, table):
+    self.table = table
+    self.ids = {}
+    self.uids = array.array("I")
+    self.gids = array.array("I")
+    self.modes = array.array("H")
+
+  def Lookup(self, paths):
+    """Return a {path: (uid, gid, mode)} dict for the given (path,
+    is_dir) pairs.  Paths not seen before are looked up in the
+    FsConfigTable if there is one, otherwise by running fs_config
+    (once for all of them)."""
+    todo = [i for i in set(paths) if i not in self.ids]
+    if todo:
+      if self.table is not None:
+        results = [self.table.Lookup(name, dir) for name, dir in todo]
+      else:
+        output = RunFsConfig(todo)
+        results = [output[name] for name, _ in todo]
+      for i, (uid, gid, mode) in zip(todo, results):
+        self.ids[i] = len(self.uids)
+        self.uids.append(uid)
+        self.gids.append(gid)
+        self.modes.append(mode)
+    result = {}
+    for i in paths:
+      n = self.ids[i]
+      result[i[0]] = (self.uids[n], self.gids[n], self.modes[n])
+    return result
+
+
+default_fs_config = None
+
+def DefaultFsConfig(paths):
+  """Return a {path: (uid, gid, mode)} dict of the default ownership
+  and permissions of the given (path, is_dir) pairs, for target-files
+  without a canned filesystem_config (see FsConfigIndex)."""
+  global default_fs_config
+  if default_fs_config is None:
+    default_fs_config = FsConfigIndex(LoadFsConfigTable())
+  return default_fs_config.Lookup(paths)
+
+
 COMMON_DOCSTRING = """
   -p  (--path)  <dir>
       Prepend <dir>/bin to the list of places to search for binaries
@@ -563,6 +1580,27 @@ COMMON_DOCSTRING = """
       Add a key/value pair to the 'extras' dict, which device-specific
       extension code may look at.
 
+  --extract_cache <dir>
+      Extract target-files zips into a directory under <dir> named
+      for the archive's contents, and reuse it in later runs (and
+      concurrent ones) on the same archive instead of unzipping again.
+
+  --extract_cache_size <megabytes>
+      Remove the least recently used extracted archives not in use
+      when the extraction cache grows beyond this size at the end of
+      a run (default 20480).  0 removes every archive not in use.
+      To list or trim the cache without running a tool on a
+      target-files, use trim_extract_cache.
+
+  --zip_threads <n>
+      Use up to <n> threads to compress each large entry of the
+      output zip (default 4).  The output doesn't depend on <n>.
+
+  --trace <file>
+      Write a Chrome trace-event JSON file (for chrome://tracing)
+      showing the time, CPU and memory used by every tool run and by
+      the major steps of the script.
+
   -v  (--verbose)
       Show command lines being executed.
 
@@ -590,7 +1628,8 @@ def ParseOptions(argv,
         argv, "hvp:s:x:" + extra_opts,
         ["help", "verbose", "path=", "signapk_path=", "extra_signapk_args=",
          "java_path=", "public_key_suffix=", "private_key_suffix=",
-         "device_specific=", "extra="] +
+         "device_specific=", "extra=", "extract_cache=",
+         "extract_cache_size=", "trace=", "zip_threads="] +
         list(extra_long_opts))
   except getopt.GetoptError, err:
     Usage(docstring)
@@ -622,6 +1661,15 @@ def ParseOptions(argv,
     elif o in ("-x", "--extra"):
       key, value = a.split("=", 1)
       OPTIONS.extras[key] = value
+    elif o in ("--extract_cache",):
+      OPTIONS.extract_cache_dir = a
+    elif o in ("--extract_cache_size",):
+      OPTIONS.extract_cache_size = int(a)
+    elif o in ("--zip_threads",):
+      OPTIONS.zip_threads = int(a)
+    elif o in ("--trace",):
+      OPTIONS.trace = Tracer(a)
+      atexit.register(OPTIONS.trace.Write)
     else:
       if extra_option_handler is None or not extra_option_handler(o, a):
         assert False, "unknown option \"%s\"" % (o,)
@@ -638,6 +1686,16 @@ def Cleanup():
       shutil.rmtree(i)
     else:
       os.remove(i)
+  OPTIONS.tempfiles = []
+
+  # Directories in the extraction cache are left for the next run;
+  # just stop holding them in use, then evict old ones.
+  for lock in OPTIONS.extract_cache_locks.itervalues():
+    lock.close()
+  OPTIONS.extract_cache_locks = {}
+  if OPTIONS.extract_cache_dir:
+    TrimExtractCache(OPTIONS.extract_cache_dir,
+                     OPTIONS.extract_cache_size << 20)
 
 
 class PasswordManager(object):
@@ -739,7 +1797,225 @@ class PasswordManager(object):
     return result
 
 
+# Entries larger than this are deflated in independent pieces of this
+# size (like "pigz -i"), by OPTIONS.zip_threads threads at once.  The
+# compressed data depends only on the contents, never on the number
+# of threads.
+DEFLATE_CHUNK_SIZE = 1 << 20
+
+class _DeflateJob(object):
+  def __init__(self, data, last):
+    self.data = data
+    self.last = last
+    self.compressed = None
+    self.error = None
+    self.done = threading.Event()
+
+  def Run(self):
+    try:
+      c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+      if self.last:
+        self.compressed = c.compress(self.data) + c.flush()
+      else:
+        # End on a byte boundary, without marking the end of the
+        # stream, so the next piece can simply be appended.
+        self.compressed = c.compress(self.data) + c.flush(zlib.Z_SYNC_FLUSH)
+    except Exception, e:
+      self.error = e
+    self.done.set()
+
+  def Result(self):
+    """Wait for Run() to finish, and return (data, compressed)."""
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.data, self.compressed
+
+
+def _Rechunk(source, size):
+  """Regroup the strings from the iterable source into pieces of
+  exactly 'size' bytes (the last may be shorter, but is only empty if
+  all of source is).  Generates (piece, is_last) pairs."""
+  ready = None
+  pending = ""
+  for data in source:
+    if pending:
+      data = pending + data
+    pos = 0
+    while len(data) - pos >= size:
+      if ready is not None:
+        yield ready, False
+      ready = data[pos:pos+size]
+      pos += size
+    pending = data[pos:]
+  if ready is None:
+    yield pending, True
+  elif pending:
+    yield ready, False
+    yield pending, True
+  else:
+    yield ready, True
+
+
+def ParallelDeflate(source):
+  """Compress the strings from the iterable source into a single raw
+  deflate stream, DEFLATE_CHUNK_SIZE bytes at a time, using up to
+  OPTIONS.zip_threads threads.  Generates (data, compressed) pairs in
+  order; the concatenation of the compressed strings is the stream."""
+  pieces = _Rechunk(source, DEFLATE_CHUNK_SIZE)
+  first = pieces.next()
+  if first[1]:
+    # Only one piece; no point in starting threads.
+    job = _DeflateJob(*first)
+    job.Run()
+    yield job.data, job.compressed
+    return
+
+  threads = max(1, OPTIONS.zip_threads)
+  queue = Queue.Queue()
+  def worker():
+    while True:
+      job = queue.get()
+      if job is None: break
+      job.Run()
+  workers = [threading.Thread(target=worker) for i in range(threads)]
+  for w in workers:
+    w.setDaemon(True)
+    w.start()
+
+  try:
+    # Keep a bounded number of pieces in flight, so memory use
+    # doesn't depend on the size of the entry.
+    in_flight = []
+    def submit(piece):
+      job = _DeflateJob(*piece)
+      in_flight.append(job)
+      queue.put(job)
+    submit(first)
+    for piece in pieces:
+      submit(piece)
+      while len(in_flight) > 2 * threads:
+        yield in_flight.pop(0).Result()
+    while in_flight:
+      yield in_flight.pop(0).Result()
+  finally:
+    for w in workers:
+      queue.put(None)
+
+
+def ZipWriteStream(zip, filename, source, perms=0644, size=None,
+                   compress_type=None):
+  """Add an entry named filename to the zip, with the same fixed
+  timestamp and permissions as ZipWriteStr, but taking its contents
+  from 'source': either a file-like object (which is read to EOF) or
+  an iterable of strings.  The contents are compressed and
+  checksummed a piece at a time, so they never have to be in memory
+  all at once; large entries are compressed by several threads (see
+  ParallelDeflate).  size is the expected length of the contents, if
+  known; it's only used to decide whether ZIP64 extensions are
+  needed.  compress_type overrides the zip's default compression for
+  this entry."""
+  if hasattr(source, "read"):
+    def chunks(f):
+      while True:
+        chunk = f.read(FILE_CHUNK_SIZE)
+        if not chunk: break
+        yield chunk
+    source = chunks(source)
+
+  zinfo = zipfile.ZipInfo(filename=filename,
+                          date_time=(2009, 1, 1, 0, 0, 0))
+  if compress_type is None:
+    compress_type = zip.compression
+  zinfo.compress_type = compress_type
+  zinfo.external_attr = perms << 16
+  zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+  zinfo.header_offset = zip.fp.tell()
+  zip._writecheck(zinfo)
+  zip._didModify = True
+
+  # Compressed data can be a little larger than the original.
+  zip64 = (zip._allowZip64 and size is not None and
+           size * 1.05 > zipfile.ZIP64_LIMIT)
+  zip.fp.write(zinfo.FileHeader(zip64))
+  if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+    pieces = ParallelDeflate(source)
+  else:
+    pieces = ((chunk, chunk) for chunk in source)
+  crc = 0
+  file_size = compress_size = 0
+  for chunk, compressed in pieces:
+    file_size += len(chunk)
+    crc = zlib.crc32(chunk, crc) & 0xffffffff
+    compress_size += len(compressed)
+    zip.fp.write(compressed)
+
+  if not zip64 and max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+    raise zipfile.LargeZipFile(
+        "%s needs ZIP64 extensions but its size wasn't given" % (filename,))
+  zinfo.CRC = crc
+  zinfo.file_size = file_size
+  zinfo.compress_size = compress_size
+
+  # Go back and fill in the CRC and sizes.
+  position = zip.fp.tell()
+  zip.fp.seek(zinfo.header_offset)
+  zip.fp.write(zinfo.FileHeader(zip64))
+  zip.fp.seek(position)
+  zip.filelist.append(zinfo)
+  zip.NameToInfo[zinfo.filename] = zinfo
+
+
+def DeflatedSize(source):
+  """Return the number of bytes the strings from the iterable source
+  take once deflated into an output zip."""
+  return sum([len(compressed) for _, compressed in ParallelDeflate(source)])
+
+
+def DeflatedSizes(files):
+  """Return a {File: size} dict of the number of bytes each of the
+  given Files takes once deflated into an output zip.  For files
+  already deflated in their target-files zip, that's the size there;
+  the rest are deflated by up to OPTIONS.worker_threads threads."""
+  sizes = {}
+  todo = []
+  for f in files:
+    if f in sizes:
+      continue
+    sizes[f] = None
+    if getattr(f, "zip", None) is not None:
+      info = f.zip.getinfo(f.zip_name)
+      if info.compress_type == zipfile.ZIP_DEFLATED:
+        sizes[f] = info.compress_size
+        continue
+    todo.append(f)
+
+  def measure(f):
+    sizes[f] = DeflatedSize(f.Chunks())
+  RunInParallel(measure, todo, OPTIONS.worker_threads)
+  return sizes
+
+
+def ZipWrite(zip, filename, arcname=None, perms=0644):
+  """Add the file 'filename' on disk to the zip as 'arcname', without
+  reading it all into memory.  Uses the same fixed timestamp and
+  permissions as ZipWriteStr."""
+  if arcname is None:
+    arcname = filename.lstrip(os.sep)
+  f = open(filename, "rb")
+  try:
+    ZipWriteStream(zip, arcname, f, perms=perms,
+                   size=os.fstat(f.fileno()).st_size)
+  finally:
+    f.close()
+
+
 def ZipWriteStr(zip, filename, data, perms=0644):
+  if (zip.compression == zipfile.ZIP_DEFLATED and
+      len(data) > DEFLATE_CHUNK_SIZE):
+    # compress it in parallel.
+    ZipWriteStream(zip, filename, [data], perms=perms, size=len(data))
+    return
   # use a fixed timestamp so the output is repeatable.
   zinfo = zipfile.ZipInfo(filename=filename,
                           date_time=(2009, 1, 1, 0, 0, 0))
@@ -748,6 +2024,71 @@ def ZipWriteStr(zip, filename, data, perms=0644):
   zip.writestr(zinfo, data)
 
 
+def _StripZip64Extra(extra):
+  """Remove any zip64 extended information record from the given
+  extra field; zipfile adds its own when one is needed."""
+  out = []
+  while len(extra) >= 4:
+    tp, ln = struct.unpack("<HH", extra[:4])
+    if tp != 1:
+      out.append(extra[:4+ln])
+    extra = extra[4+ln:]
+  return "".join(out)
+
+
+def ZipCopyRaw(input_zip, output_zip, info, arcname=None):
+  """Copy the entry described by the ZipInfo 'info' from input_zip to
+  output_zip (as 'arcname', if given) without decompressing it.  The
+  compressed bytes, CRC, sizes, compression method, timestamp and
+  permissions are carried over unchanged, whatever the default
+  compression of output_zip.  input_zip may be a ZipFile or a
+  TargetFiles."""
+  if info.flag_bits & 0x1:
+    raise ExternalError("can't copy encrypted entry %s" % (info.filename,))
+
+  # Use a private handle on the input so that other threads can read
+  # from input_zip at the same time.
+  own_fp = bool(getattr(input_zip, "filename", None))
+  if own_fp:
+    fp = open(input_zip.filename, "rb")
+  else:
+    fp = input_zip.fp
+  try:
+    fp.seek(info.header_offset)
+    fheader = fp.read(zipfile.sizeFileHeader)
+    if len(fheader) != zipfile.sizeFileHeader:
+      raise ExternalError("truncated header for %s" % (info.filename,))
+    fheader = struct.unpack(zipfile.structFileHeader, fheader)
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+      raise ExternalError("bad local header for %s" % (info.filename,))
+    fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] +
+            fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    zinfo = copy.copy(info)
+    if arcname is not None:
+      zinfo.filename = arcname
+    # The sizes and CRC are known up front, so no data descriptor.
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = _StripZip64Extra(info.extra)
+    zinfo.header_offset = output_zip.fp.tell()
+    output_zip._writecheck(zinfo)
+    output_zip._didModify = True
+    output_zip.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+      data = fp.read(min(remaining, FILE_CHUNK_SIZE))
+      if not data:
+        raise ExternalError("truncated data for %s" % (info.filename,))
+      output_zip.fp.write(data)
+      remaining -= len(data)
+    output_zip.fp.flush()
+    output_zip.filelist.append(zinfo)
+    output_zip.NameToInfo[zinfo.filename] = zinfo
+  finally:
+    if own_fp:
+      fp.close()
+
+
 class DeviceSpecificParams(object):
   module = None
   def __init__(self, **kwargs):
@@ -829,18 +2170,27 @@ class DeviceSpecificParams(object):
     return self._DoCall("IncrementalOTA_InstallEnd")
 
 class File(object):
-  def __init__(self, name, data):
+  def __init__(self, name, data, path=None):
     self.name = name
     self.data = data
     self.size = len(data)
     self.sha1 = sha1(data).hexdigest()
+    self.path = path
 
   @classmethod
   def FromLocalFile(cls, name, diskname):
     f = open(diskname, "rb")
     data = f.read()
     f.close()
-    return File(name, data)
+    return File(name, data, path=diskname)
+
+  def DiskPath(self):
+    """Return the name of a file on disk holding the contents, or None
+    if they're only in memory."""
+    return self.path
+
+  def Chunks(self):
+    return [self.data]
 
   def WriteToTemp(self):
     t = tempfile.NamedTemporaryFile()
@@ -851,6 +2201,89 @@ class File(object):
   def AddToZip(self, z):
     ZipWriteStr(z, self.name, self.data)
 
+
+# Size of the pieces LazyFile reads at a time when hashing or copying.
+FILE_CHUNK_SIZE = 1 << 20
+
+class LazyFile(File):
+  """A File whose contents stay in the target-files zip (or in the
+  directory it was extracted to) until they are actually needed.
+  Hashing and copying are done a chunk at a time, so only the
+  consumers that really want the whole string in memory (by touching
+  .data) pay for it."""
+
+  def __init__(self, name, zip=None, zip_name=None, path=None):
+    assert (zip is None) != (path is None)
+    self.name = name
+    self.zip = zip
+    self.zip_name = zip_name
+    self.path = path
+    if path is not None:
+      self.size = os.path.getsize(path)
+      self.crc = None
+    else:
+      info = zip.getinfo(zip_name)
+      self.size = info.file_size
+      self.crc = info.CRC
+    self._sha1 = None
+
+  @classmethod
+  def FromZip(cls, name, zip, zip_name):
+    return cls(name, zip=zip, zip_name=zip_name)
+
+  @classmethod
+  def FromPath(cls, name, path):
+    return cls(name, path=path)
+
+  def DiskPath(self):
+    if self.path is not None:
+      return self.path
+    if hasattr(self.zip, "LocalPath"):
+      return self.zip.LocalPath(self.zip_name)
+    return None
+
+  def Open(self):
+    """Return a new file-like object positioned at the start of the
+    contents."""
+    if self.path is not None:
+      return open(self.path, "rb")
+    return self.zip.open(self.zip_name)
+
+  def Chunks(self):
+    """Generate the contents as a sequence of strings of at most
+    FILE_CHUNK_SIZE bytes each."""
+    f = self.Open()
+    try:
+      while True:
+        chunk = f.read(FILE_CHUNK_SIZE)
+        if not chunk: break
+        yield chunk
+    finally:
+      f.close()
+
+  def _GetData(self):
+    return "".join(self.Chunks())
+  data = property(_GetData)
+
+  def _GetSha1(self):
+    if self._sha1 is None:
+      h = sha1()
+      for chunk in self.Chunks():
+        h.update(chunk)
+      self._sha1 = h.hexdigest()
+    return self._sha1
+  sha1 = property(_GetSha1)
+
+  def WriteToTemp(self):
+    t = tempfile.NamedTemporaryFile()
+    for chunk in self.Chunks():
+      t.write(chunk)
+    t.flush()
+    return t
+
+  def AddToZip(self, z):
+    ZipWriteStream(z, self.name, self.Chunks(), size=self.size)
+
 DIFF_PROGRAM_BY_EXT = {
     ".gz" : "imgdiff",
     ".zip" : ["imgdiff", "-z"],
@@ -859,55 +2292,329 @@ DIFF_PROGRAM_BY_EXT = {
     ".img" : "imgdiff",
     }
 
+def _HasMagic(f, magic, anywhere=False):
+  """Return true if f's contents start with (or, if anywhere is
+  true, contain) the string magic."""
+  tail = ""
+  for chunk in f.Chunks():
+    data = tail + chunk
+    if not anywhere:
+      if len(data) >= len(magic):
+        return data.startswith(magic)
+      tail = data
+    elif magic in data:
+      return True
+    else:
+      tail = data[-(len(magic) - 1):]
+  return False
+
+def DiffProgramsFor(tf, sf):
+  """Return the diff commands (as for Difference's diff_program) that
+  can turn sf into tf: bsdiff always, imgdiff if both contain gzipped
+  data, and imgdiff -z if both are zip archives."""
+  cmds = [["bsdiff"]]
+  gzip_magic = "\x1f\x8b\x08"
+  if _HasMagic(tf, gzip_magic, True) and _HasMagic(sf, gzip_magic, True):
+    cmds.append(["imgdiff"])
+  if _HasMagic(tf, "PK\x03\x04") and _HasMagic(sf, "PK\x03\x04"):
+    cmds.append(["imgdiff", "-z"])
+  return cmds
+
+class PatchCache(object):
+  """An on-disk store of previously computed patches, shared between
+  runs (and between concurrent runs) of the OTA tools.
+
+  Patches are keyed by the sha1 of the source and target files and by
+  the diff program and its arguments, so a patch is reused only when
+  the same program would be run on the same inputs.  Each patch is a
+  file in the cache directory; it is written under a temporary name
+  and renamed into place so readers never see a partial patch.  The
+  mtime of an entry is bumped whenever it is used, and Trim() deletes
+  the least recently used entries once the cache exceeds max_size
+  bytes."""
+
+  def __init__(self, path, max_size):
+    self.path = path
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.bytes_reused = 0
+    self.lock = threading.Lock()
+    self.arg_digests = {}
+    try:
+      os.makedirs(path)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def Key(self, sf, tf, cmd):
+    """Return the cache key for running 'cmd' (the diff program and
+    any extra arguments) to turn File sf into File tf."""
+    parts = [sf.sha1, tf.sha1]
+    for arg in cmd:
+      # Extra input files (such as imgdiff's -b bonus file) usually
+      # live in a temp dir; key on their contents, not their names.
+      if os.path.isfile(arg):
+        parts.append(self._FileDigest(arg))
+      else:
+        parts.append(arg)
+    return sha1("\0".join(parts)).hexdigest()
+
+  def _FileDigest(self, filename):
+    self.lock.acquire()
+    try:
+      if filename not in self.arg_digests:
+        self.arg_digests[filename] = File.FromLocalFile(
+            filename, filename).sha1
+      return self.arg_digests[filename]
+    finally:
+      self.lock.release()
+
+  def _EntryPath(self, key):
+    return os.path.join(self.path, key[:2], key)
+
+  def Get(self, key):
+    """Return the cached patch data for key, or None if there isn't
+    one."""
+    fn = self._EntryPath(key)
+    try:
+      f = open(fn, "rb")
+      try:
+        data = f.read()
+      finally:
+        f.close()
+      os.utime(fn, None)
+    except (IOError, OSError):
+      data = None
+
+    self.lock.acquire()
+    if data is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self.bytes_reused += len(data)
+    self.lock.release()
+    return data
+
+  def Put(self, key, data):
+    """Store the patch data for key."""
+    dirname = os.path.dirname(self._EntryPath(key))
+    try:
+      os.makedirs(dirname)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    fd, temp_name = tempfile.mkstemp(prefix=".tmp-", dir=dirname)
+    try:
+      f = os.fdopen(fd, "wb")
+      f.write(data)
+      f.close()
+      os.rename(temp_name, self._EntryPath(key))
+    except:
+      if os.path.exists(temp_name):
+        os.remove(temp_name)
+      raise
+
+  def Trim(self):
+    """Delete least recently used entries until the cache is no
+    larger than max_size bytes."""
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(self.path):
+      for fn in filenames:
+        if fn.startswith(".tmp-"): continue
+        fn = os.path.join(dirpath, fn)
+        try:
+          st = os.stat(fn)
+        except OSError:
+          continue   # removed by a concurrent Trim()
+        entries.append((st.st_mtime, st.st_size, fn))
+        total += st.st_size
+
+    entries.sort()
+    for _, size, fn in entries:
+      if total <= self.max_size: break
+      try:
+        os.remove(fn)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+      total -= size
+
+  def PrintStats(self):
+    lookups = self.hits + self.misses
+    if lookups:
+      pct = 100.0 * self.hits / lookups
+    else:
+      pct = 0.0
+    print "patch cache: %d hits, %d misses (%.1f%% hit rate), %d bytes reused" % (
+        self.hits, self.misses, pct, self.bytes_reused)
+
+
+class PatchJournal(PatchCache):
+  """A record of the patches computed by one run of the OTA tools, so
+  that if the run dies, running it again with the same inputs only
+  computes the patches it hadn't finished.
+
+  Patches are stored as in a PatchCache, as each one is computed.  The
+  MANIFEST file in the directory identifies the inputs of the run
+  (see ota_from_target_files); a journal left by a run with different
+  inputs is discarded.  Nothing is ever trimmed: Discard() removes the
+  whole journal once the run has succeeded."""
+
+  def __init__(self, path, inputs):
+    PatchCache.__init__(self, path, None)
+    manifest = "".join(["%s\n" % (i,) for i in inputs])
+    manifest_path = os.path.join(path, "MANIFEST")
+    try:
+      f = open(manifest_path)
+      try:
+        old_manifest = f.read()
+      finally:
+        f.close()
+    except IOError:
+      old_manifest = None
+
+    if old_manifest == manifest:
+      entries = 0
+      for dirpath, dirnames, filenames in os.walk(path):
+        entries += len([fn for fn in filenames
+                        if fn != "MANIFEST" and not fn.startswith(".tmp-")])
+      print "resuming from journal %s (%d patches)" % (path, entries)
+      return
+
+    if old_manifest is not None:
+      print "journal %s is for different inputs; starting over" % (path,)
+      shutil.rmtree(path)
+      os.makedirs(path)
+    elif os.listdir(path):
+      raise ExternalError("%s is not empty, and not a patch journal" %
+                          (path,))
+    f = open(manifest_path + ".tmp", "w")
+    f.write(manifest)
+    f.close()
+    os.rename(manifest_path + ".tmp", manifest_path)
+
+  def Trim(self):
+    pass
+
+  def Discard(self):
+    shutil.rmtree(self.path)
+
+  def PrintStats(self):
+    print "patch journal: %d patches reloaded" % (self.hits,)
+
+
+def PatchStores():
+  """Return the places patches are looked up in and saved to: the
+  journal of this run, then the shared patch cache, if there are
+  any."""
+  return [s for s in (OPTIONS.patch_journal, OPTIONS.patch_cache)
+          if s is not None]
+
+
 class Difference(object):
   def __init__(self, tf, sf, diff_program=None):
     self.tf = tf
     self.sf = sf
     self.patch = None
     self.diff_program = diff_program
+    self.cache_checked = False
+    self.peak_rss = None
+    # Set when the target must be sent whole, whatever the patch.
+    self.force_verbatim = False
+    self.deflated_patch = None
+
+  def GetDiffCommand(self):
+    """Return the diff program to run (as a list of the program and
+    any extra arguments, not including the filenames)."""
+    if self.diff_program:
+      diff_program = self.diff_program
+    else:
+      ext = os.path.splitext(self.tf.name)[1]
+      diff_program = DIFF_PROGRAM_BY_EXT.get(ext, "bsdiff")
+    if isinstance(diff_program, list):
+      return copy.copy(diff_program)
+    else:
+      return [diff_program]
+
+  def LoadCachedPatch(self):
+    """Fill in the patch from OPTIONS.patch_journal or
+    OPTIONS.patch_cache, if either has one for this pair of files.
+    Returns true if it did."""
+    stores = PatchStores()
+    if not stores or self.cache_checked:
+      return False
+    self.cache_checked = True
+    key = stores[0].Key(self.sf, self.tf, self.GetDiffCommand())
+    for store in stores:
+      patch = store.Get(key)
+      if patch is not None:
+        self.patch = patch
+        return True
+    return False
 
   def ComputePatch(self):
     """Compute the patch (as a string of data) needed to turn sf into
     tf.  Returns the same tuple as GetPatch()."""
 
+    if self.patch is not None or self.LoadCachedPatch():
+      return self.tf, self.sf, self.patch
+
     tf = self.tf
     sf = self.sf
 
-    if self.diff_program:
-      diff_program = self.diff_program
-    else:
-      ext = os.path.splitext(tf.name)[1]
-      diff_program = DIFF_PROGRAM_BY_EXT.get(ext, "bsdiff")
-
-    ttemp = tf.WriteToTemp()
-    stemp = sf.WriteToTemp()
-
-    ext = os.path.splitext(tf.name)[1]
-
+    cmd = self.GetDiffCommand()
+    diff_program = cmd[0]
+    stores = PatchStores()
+    cache_key = None
+    if stores:
+      cache_key = stores[0].Key(sf, tf, cmd)
+
+    # Diff the files where they already are on disk, if they are;
+    # otherwise write them out to temp files.
+    temps = []
+    paths = []
+    for f in (sf, tf):
+      path = f.DiskPath()
+      if path is None:
+        t = f.WriteToTemp()
+        temps.append(t)
+        path = t.name
+      paths.append(path)
+
+    ptemp = tempfile.NamedTemporaryFile()
     try:
-      ptemp = tempfile.NamedTemporaryFile()
-      if isinstance(diff_program, list):
-        cmd = copy.copy(diff_program)
-      else:
-        cmd = [diff_program]
-      cmd.append(stemp.name)
-      cmd.append(ttemp.name)
+      cmd.extend(paths)
       cmd.append(ptemp.name)
       p = Run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      _, err = p.communicate()
+      _, err, rusage = Communicate(p)
+      self.peak_rss = PeakRss(rusage)
       if err or p.returncode != 0:
         print "WARNING: failure running %s:\n%s\n" % (diff_program, err)
         return None
       diff = ptemp.read()
     finally:
       ptemp.close()
-      stemp.close()
-      ttemp.close()
+      for t in temps:
+        t.close()
 
     self.patch = diff
+    for store in stores:
+      store.Put(cache_key, diff)
     return self.tf, self.sf, self.patch
 
 
+  def DeflatedPatchSize(self):
+    """Return the number of bytes the patch takes once deflated into
+    an output zip (memoized until the patch changes), or None if
+    there's no patch."""
+    if self.patch is None:
+      return None
+    if self.deflated_patch is None or self.deflated_patch[0] is not self.patch:
+      self.deflated_patch = (self.patch, DeflatedSize([self.patch]))
+    return self.deflated_patch[1]
+
   def GetPatch(self):
     """Return a tuple (target_file, source_file, patch_data).
     patch_data may be None if ComputePatch hasn't been called, or if
@@ -915,50 +2622,259 @@ class Difference(object):
     return self.tf, self.sf, self.patch
 
 
-def ComputeDifferences(diffs):
-  """Call ComputePatch on all the Difference objects in 'diffs'."""
-  print len(diffs), "diffs to compute"
+def DiffProgramName(cmd):
+  """Return the name the cost model uses for the diff command 'cmd':
+  the program and its flags, without any input file arguments."""
+  return " ".join([cmd[0]] + [i for i in cmd[1:] if not os.path.isfile(i)])
+
+
+class DiffCostModel(object):
+  """Predicts how long a diff will take and how much memory it will
+  use, as a per-byte rate for each diff program applied to the
+  combined size of the source and target.
+
+  The rates start out at rough built-in values and are refined with
+  the measured duration and peak RSS of every diff that is run.  If a
+  filename is given, the rates are loaded from it at startup and
+  written back by Save(), so each run learns from the previous ones.
+
+  The model also keeps the average patch size, as a fraction of the
+  target file size, for each kind of file (see FileKind) diffed with
+  its default program; ota_from_target_files --estimate uses it."""
+
+  # program: (seconds per byte, peak RSS bytes per byte)
+  DEFAULT_RATES = {
+      "bsdiff": (4.0e-7, 9.0),
+      "imgdiff": (6.0e-7, 12.0),
+      "imgdiff -z": (1.5e-6, 24.0),
+      }
+  # Memory used by a diff program regardless of input size.
+  BASE_RSS = 4 << 20
+  # Recent samples count for at least 1/MAX_SAMPLES of the rate.
+  MAX_SAMPLES = 20
+
+  def __init__(self, filename=None):
+    self.filename = filename
+    self.rates = {}   # program: [secs per byte, rss per byte, samples]
+    self.ratios = {}  # kind: [patch size / target size, samples]
+    self.lock = threading.Lock()
+    if filename and os.path.exists(filename):
+      self.Load()
+
+  def Load(self):
+    f = open(self.filename)
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith("#"): continue
+      if line.startswith("ratio "):
+        _, kind, ratio, samples = line.split()
+        self.ratios[kind] = [float(ratio), int(samples)]
+        continue
+      program, secs, rss, samples = line.rsplit(None, 3)
+      self.rates[program] = [float(secs), float(rss), int(samples)]
+    f.close()
 
-  # Do the largest files first, to try and reduce the long-pole effect.
-  by_size = [(i.tf.size, i) for i in diffs]
-  by_size.sort(reverse=True)
-  by_size = [i[1] for i in by_size]
+  def Save(self):
+    """Write the learned rates back to the file they came from."""
+    if not self.filename: return
+    temp_name = self.filename + ".tmp-%d" % (os.getpid(),)
+    f = open(temp_name, "w")
+    f.write("# program secs_per_byte rss_per_byte samples\n")
+    for program, (secs, rss, samples) in sorted(self.rates.iteritems()):
+      f.write("%s %.6g %.6g %d\n" % (program, secs, rss, samples))
+    f.write("# ratio kind patch_size_per_byte samples\n")
+    for kind, (ratio, samples) in sorted(self.ratios.iteritems()):
+      f.write("ratio %s %.6g %d\n" % (kind, ratio, samples))
+    f.close()
+    os.rename(temp_name, self.filename)
+
+  def _Rates(self, program):
+    if program in self.rates:
+      return self.rates[program][:2]
+    return self.DEFAULT_RATES.get(program.split()[0],
+                                  self.DEFAULT_RATES["bsdiff"])
+
+  def Estimate(self, program, size):
+    """Return (seconds, peak RSS bytes) predicted for running program
+    on inputs totalling size bytes."""
+    self.lock.acquire()
+    try:
+      secs, rss = self._Rates(program)
+    finally:
+      self.lock.release()
+    return secs * size, self.BASE_RSS + rss * size
 
-  lock = threading.Lock()
-  diff_iter = iter(by_size)   # accessed under lock
+  def Record(self, program, size, secs, rss):
+    """Fold one measured run into the rates for program."""
+    if size <= 0: return
+    self.lock.acquire()
+    try:
+      if program in self.rates:
+        old_secs, old_rss, samples = self.rates[program]
+      else:
+        old_secs, old_rss = self._Rates(program)
+        samples = 0
+      samples += 1
+      w = 1.0 / min(samples, self.MAX_SAMPLES)
+      new_rss = max(rss - self.BASE_RSS, 0)
+      self.rates[program] = [old_secs + w * (float(secs) / size - old_secs),
+                             old_rss + w * (float(new_rss) / size - old_rss),
+                             samples]
+    finally:
+      self.lock.release()
 
-  def worker():
+
+  def Ratio(self, kind):
+    """Return (patch size per target byte, samples) for files of the
+    given kind, or None if none have been diffed."""
+    self.lock.acquire()
     try:
-      lock.acquire()
-      for d in diff_iter:
-        lock.release()
-        start = time.time()
-        d.ComputePatch()
-        dur = time.time() - start
-        lock.acquire()
+      if kind not in self.ratios:
+        return None
+      return tuple(self.ratios[kind])
+    finally:
+      self.lock.release()
 
-        tf, sf, patch = d.GetPatch()
-        if sf.name == tf.name:
-          name = tf.name
-        else:
-          name = "%s (%s)" % (tf.name, sf.name)
-        if patch is None:
-          print "patching failed!                                  %s" % (name,)
-        else:
-          print "%8.2f sec %8d / %8d bytes (%6.2f%%) %s" % (
-              dur, len(patch), tf.size, 100.0 * len(patch) / tf.size, name)
-      lock.release()
-    except Exception, e:
-      print e
-      raise
+  def RecordRatio(self, kind, size, patch_size):
+    """Fold one patch size into the ratio for kind."""
+    if size <= 0: return
+    self.lock.acquire()
+    try:
+      ratio, samples = self.ratios.get(kind, [0.0, 0])
+      samples += 1
+      w = 1.0 / min(samples, self.MAX_SAMPLES)
+      self.ratios[kind] = [ratio + w * (float(patch_size) / size - ratio),
+                           samples]
+    finally:
+      self.lock.release()
 
-  # start worker threads; wait for them all to finish.
-  threads = [threading.Thread(target=worker)
-             for i in range(OPTIONS.worker_threads)]
-  for th in threads:
-    th.start()
-  while threads:
-    threads.pop().join()
+
+def FileKind(name):
+  """Return the kind of file name is, for DiffCostModel's patch
+  ratios: its extension, or "-" if it has none."""
+  return os.path.splitext(name)[1].lower() or "-"
+
+
+def ComputeDifferences(diffs, deadline=None):
+  """Call ComputePatch on all the Difference objects in 'diffs'.
+
+  Up to OPTIONS.worker_threads diffs run at once.  The diffs expected
+  to take longest (according to OPTIONS.diff_cost_model) are started
+  first, to reduce the long-pole effect.  If
+  OPTIONS.diff_memory_budget is set, a diff is only started when its
+  predicted peak memory fits alongside the ones already running;
+  otherwise a smaller diff that does fit is started instead.
+
+  Diffs that turn the same source contents into the same target
+  contents with the same program are only computed once; the others
+  share the resulting patch string.
+
+  If deadline (a time.time() value) is given, no diff is started
+  after it; the ones left are skipped and have no patch."""
+  groups = {}
+  unique = []
+  for d in diffs:
+    key = (d.sf.sha1, d.tf.sha1, tuple(d.GetDiffCommand()))
+    if key in groups:
+      groups[key].append(d)
+    else:
+      groups[key] = [d]
+      unique.append(d)
+  duplicates = len(diffs) - len(unique)
+  all_diffs = diffs
+  diffs = unique
+
+  if PatchStores():
+    diffs = [d for d in diffs if not d.LoadCachedPatch()]
+  if duplicates:
+    print len(diffs), "diffs to compute (%d duplicates skipped)" % (duplicates,)
+  else:
+    print len(diffs), "diffs to compute"
+
+  model = OPTIONS.diff_cost_model
+  if model is None:
+    model = DiffCostModel()
+  budget = OPTIONS.diff_memory_budget
+
+  pending = []
+  for d in diffs:
+    program = DiffProgramName(d.GetDiffCommand())
+    size = d.tf.size + d.sf.size
+    secs, rss = model.Estimate(program, size)
+    pending.append((secs, rss, program, size, d))
+  pending.sort(key=lambda job: job[0], reverse=True)
+
+  cv = threading.Condition()
+  # [memory reserved by running diffs, number of running diffs];
+  # accessed under cv, like pending.
+  running = [0, 0]
+
+  def next_job():
+    while pending:
+      if deadline is not None and time.time() > deadline:
+        print "out of time; skipping %d diffs" % (len(pending),)
+        del pending[:]
+        break
+      for i, job in enumerate(pending):
+        if running[1] == 0 or budget is None or running[0] + job[1] <= budget:
+          return pending.pop(i)
+      cv.wait()
+    return None
+
+  def start_jobs():
+    # Generates the jobs in turn, each once there's room for it.
+    while True:
+      cv.acquire()
+      try:
+        job = next_job()
+        if job is None: return
+        running[0] += job[1]
+        running[1] += 1
+      finally:
+        cv.release()
+      yield job
+
+  def run(job):
+    _, rss, program, size, d = job
+    start = time.time()
+    try:
+      d.ComputePatch()
+    finally:
+      cv.acquire()
+      running[0] -= rss
+      running[1] -= 1
+      cv.notifyAll()
+      cv.release()
+    dur = time.time() - start
+
+    cv.acquire()
+    try:
+      tf, sf, patch = d.GetPatch()
+      if sf.name == tf.name:
+        name = tf.name
+      else:
+        name = "%s (%s)" % (tf.name, sf.name)
+      if patch is None:
+        print "patching failed!                                  %s" % (name,)
+      else:
+        print "%8.2f sec %8d / %8d bytes (%6.2f%%) %s" % (
+            dur, len(patch), tf.size, 100.0 * len(patch) / tf.size, name)
+        if d.peak_rss is not None:
+          model.Record(program, size, dur, d.peak_rss)
+        if not d.diff_program:
+          model.RecordRatio(FileKind(tf.name), tf.size, len(patch))
+    finally:
+      cv.release()
+
+  span = TraceSpan("ComputeDifferences", diffs=len(diffs))
+  RunInParallel(run, start_jobs(), OPTIONS.worker_threads)
+  span.End()
+
+  for group in groups.itervalues():
+    for d in group[1:]:
+      d.patch = group[0].patch
+
+  model.Save()
 
 
 # map recovery.fstab's fs_types to mount/format "partition types"
@@ -138,6 +138,31 @@ class EdifyGenerator(object):
                        "".join([', "%s"' % (i,) for i in sha1]) +
                        '));')
 
+  def BlockImageCheck(self, device, src_ranges, src_sha1,
+                      tgt_ranges, tgt_sha1):
+    """Check that the given blocks of the block device hash to
+    src_sha1 (it holds the source build) or that the target blocks
+    hash to tgt_sha1 (it has already been updated).  Ranges are in
+    the form produced by blockimgdiff.RangeSet.ToRaw()."""
+    cmd = ('assert(range_sha1("%s", "%s") == "%s" ||\0'
+           'range_sha1("%s", "%s") == "%s");'
+           % (device, src_ranges, src_sha1, device, tgt_ranges, tgt_sha1))
+    self.script.append(self._WordWrap(cmd))
+
+  def BlockImageUpdate(self, device, prefix, tgt_ranges, tgt_sha1):
+    """Apply the transfer list <prefix>.transfer.list (with its data in
+    <prefix>.new.dat and <prefix>.patch.dat) from the package to the
+    block device, unless the target blocks already hash to
+    tgt_sha1."""
+    args = {"device": device, "prefix": prefix,
+            "ranges": tgt_ranges, "sha1": tgt_sha1}
+    self.script.append(
+        ('if range_sha1("%(device)s", "%(ranges)s") != "%(sha1)s" then\n'
+         '  block_image_update("%(device)s", '
+         'package_extract_file("%(prefix)s.transfer.list"), '
+         '"%(prefix)s.new.dat", "%(prefix)s.patch.dat");\n'
+         'endif;') % args)
+
   def CacheFreeSpaceCheck(self, amount):
     """Check that there's at least 'amount' space that can be made
     available on /cache."""
@@ -273,8 +298,12 @@ class EdifyGenerator(object):
                        "\n".join(self.script) + "\n")
 
     if input_path is None:
-      data = input_zip.read("OTA/bin/updater")
+      f = input_zip.open("OTA/bin/updater")
     else:
-      data = open(os.path.join(input_path, "updater")).read()
-    common.ZipWriteStr(output_zip, "META-INF/com/google/android/update-binary",
-                       data, perms=0755)
+      f = open(os.path.join(input_path, "updater"), "rb")
+    try:
+      common.ZipWriteStream(output_zip,
+                            "META-INF/com/google/android/update-binary",
+                            f, perms=0755)
+    finally:
+      f.close()
@@ -0,0 +1,91 @@
+# Copyright (C) 2014 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+
+import blockimgdiff
+import common
+
+BLOCK_SIZE = 4096
+
+
+def Block(text):
+  return (text * BLOCK_SIZE)[:BLOCK_SIZE]
+
+
+class BlockImageDiffTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    # Stand in for bsdiff, which may not be on the PATH.
+    self.compute_differences = common.ComputeDifferences
+    def compute(diffs, deadline=None):
+      for d in diffs:
+        d.patch = "patch for %s\n" % (d.tf.name,)
+    common.ComputeDifferences = compute
+
+  def tearDown(self):
+    common.ComputeDifferences = self.compute_differences
+    shutil.rmtree(self.tmp)
+
+  def WriteImage(self, name, blocks):
+    path = os.path.join(self.tmp, name)
+    f = open(path, "wb")
+    try:
+      f.write("".join(blocks))
+    finally:
+      f.close()
+    return blockimgdiff.Image(path)
+
+  def testPatchDataIsStored(self):
+    src = self.WriteImage("src.img", [Block("a"), Block("b"), Block("c")])
+    tgt = self.WriteImage("tgt.img", [Block("a"), Block("B"), Block("c")])
+    diff = blockimgdiff.BlockImageDiff(tgt, src, "system")
+    diff.Compute()
+
+    path = os.path.join(self.tmp, "ota.zip")
+    output_zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+    diff.WriteToZip(output_zip, "system")
+    output_zip.close()
+
+    output_zip = zipfile.ZipFile(path)
+    try:
+      info = output_zip.getinfo("system.patch.dat")
+      self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+      transfers = output_zip.read("system.transfer.list").split("\n")
+      patches = [line.split() for line in transfers
+                 if line.startswith("bsdiff ")]
+      self.assertEqual(len(patches), 1)
+      offset, length = int(patches[0][1]), int(patches[0][2])
+    finally:
+      output_zip.close()
+
+    # The updater reads each patch at its offset in the raw entry data.
+    f = open(path, "rb")
+    try:
+      f.seek(info.header_offset + 26)
+      name_length, extra_length = struct.unpack("<HH", f.read(4))
+      f.seek(info.header_offset + 30 + name_length + extra_length + offset)
+      self.assertEqual(f.read(length), "patch for system blocks 1-1\n")
+    finally:
+      f.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
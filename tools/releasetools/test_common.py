@@ -0,0 +1,471 @@
+# Copyright (C) 2014 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+import zipfile
+import zlib
+
+import common
+
+OPTIONS = common.OPTIONS
+
+
+def FindProgram(name):
+  for d in os.environ.get("PATH", "").split(os.pathsep):
+    path = os.path.join(d, name)
+    if os.access(path, os.X_OK):
+      return path
+  return None
+
+
+class PatchCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, "cache")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def Key(self, cache, i, cmd=("bsdiff",)):
+    return cache.Key(common.File("a", "source %d" % (i,)),
+                     common.File("a", "target %d" % (i,)), list(cmd))
+
+  def testHitAndMiss(self):
+    cache = common.PatchCache(self.path, 1 << 20)
+    key = self.Key(cache, 0)
+    self.assertEqual(cache.Get(key), None)
+    cache.Put(key, "patch")
+    self.assertEqual(cache.Get(key), "patch")
+    # Another diff program makes another patch.
+    self.assertEqual(cache.Get(self.Key(cache, 0, ["imgdiff"])), None)
+    self.assertEqual((cache.hits, cache.misses), (1, 2))
+    self.assertEqual(cache.bytes_reused, len("patch"))
+
+  def testTrimRemovesLeastRecentlyUsed(self):
+    cache = common.PatchCache(self.path, 250)
+    keys = [self.Key(cache, i) for i in range(3)]
+    for i, key in enumerate(keys):
+      cache.Put(key, "x" * 100)
+      os.utime(cache._EntryPath(key), (1000 + i, 1000 + i))
+    # Using the oldest entry makes it the most recently used.
+    self.assertNotEqual(cache.Get(keys[0]), None)
+    cache.Trim()
+    self.assertNotEqual(cache.Get(keys[0]), None)
+    self.assertEqual(cache.Get(keys[1]), None)
+    self.assertNotEqual(cache.Get(keys[2]), None)
+
+
+class ExtractCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.saved = (OPTIONS.extract_cache_dir, OPTIONS.extract_cache_locks)
+    OPTIONS.extract_cache_dir = os.path.join(self.tmp, "cache")
+    OPTIONS.extract_cache_locks = {}
+
+  def tearDown(self):
+    for lock in OPTIONS.extract_cache_locks.itervalues():
+      lock.close()
+    OPTIONS.extract_cache_dir, OPTIONS.extract_cache_locks = self.saved
+    shutil.rmtree(self.tmp)
+
+  def MakeZip(self, name, build_id):
+    path = os.path.join(self.tmp, name)
+    z = zipfile.ZipFile(path, "w")
+    z.writestr("META/misc_info.txt", "recovery_api_version=3\n")
+    z.writestr("SYSTEM/build.prop", "ro.build.id=%s\n" % (build_id,))
+    z.close()
+    return path
+
+  def testSecondUnzipReusesDirectory(self):
+    path = self.MakeZip("target_files.zip", "A")
+    tmp, input_zip = common.UnzipTemp(path, "META/*")
+    input_zip.close()
+    common.ReleaseUnzipTemp(tmp)
+    misc_info = os.path.join(tmp, "META", "misc_info.txt")
+    inode = os.stat(misc_info).st_ino
+    self.assertFalse(os.path.exists(os.path.join(tmp, "SYSTEM")))
+
+    # Only the entries missing from the directory are extracted.
+    tmp2, input_zip = common.UnzipTemp(path)
+    input_zip.close()
+    self.assertEqual(tmp2, tmp)
+    self.assertEqual(os.stat(misc_info).st_ino, inode)
+    self.assertEqual(open(os.path.join(tmp, "SYSTEM", "build.prop")).read(),
+                     "ro.build.id=A\n")
+
+  def testTrimSkipsEntryInUse(self):
+    in_use, input_zip = common.UnzipTemp(self.MakeZip("a.zip", "A"))
+    input_zip.close()
+    unused, input_zip = common.UnzipTemp(self.MakeZip("b.zip", "B"))
+    input_zip.close()
+    common.ReleaseUnzipTemp(unused)
+    self.assertTrue(common.ExtractCacheEntryInUse(in_use))
+    self.assertFalse(common.ExtractCacheEntryInUse(unused))
+
+    common.TrimExtractCache(OPTIONS.extract_cache_dir, 0)
+    self.assertTrue(os.path.isdir(in_use))
+    self.assertFalse(os.path.exists(unused))
+    self.assertEqual([path for _, _, path in
+                      common.ExtractCacheEntries(OPTIONS.extract_cache_dir)],
+                     [in_use])
+
+
+class RamdiskCpioTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.ramdisk = os.path.join(self.tmp, "RAMDISK")
+    for d in ("sbin", "system", "root", "data/root"):
+      os.makedirs(os.path.join(self.ramdisk, d))
+    for fn, data in (("init", "\x7fELF" + "x" * 1000),
+                     ("init.rc", "on boot\n"),
+                     ("default.prop", "ro.secure=1\n"),
+                     ("sbin/adbd", "adbd"),
+                     ("root/skipped", "not archived"),
+                     (".hidden", "not archived")):
+      f = open(os.path.join(self.ramdisk, fn), "wb")
+      f.write(data)
+      f.close()
+    os.symlink("/init", os.path.join(self.ramdisk, "sbin/ueventd"))
+
+    self.fs_config = os.path.join(self.tmp, "boot_filesystem_config.txt")
+    f = open(self.fs_config, "w")
+    f.write(" 0 0 755\n"
+            "init 0 2000 750\n"
+            "init.rc 0 2000 750\n"
+            "default.prop 0 0 644\n"
+            "sbin 0 2000 750\n"
+            "sbin/adbd 0 2000 750\n"
+            "sbin/ueventd 0 0 777\n"
+            "system 0 0 755\n"
+            "data 1000 1000 771\n")
+    f.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def ReadArchive(self, data):
+    """Return a list of (name, mode, uid, gid, contents) for the
+    entries of a newc cpio archive."""
+    entries = []
+    pos = 0
+    while True:
+      self.assertEqual(data[pos:pos+6], "070701")
+      fields = [int(data[pos+6+8*i:pos+14+8*i], 16) for i in range(13)]
+      name_size = fields[11]
+      name = data[pos+110:pos+110+name_size-1]
+      pos += 110 + name_size
+      pos += -pos % 4
+      contents = data[pos:pos+fields[6]]
+      pos += fields[6]
+      pos += -pos % 4
+      if name == "TRAILER!!!":
+        return entries
+      entries.append((name, fields[1], fields[2], fields[3], contents))
+
+  def testCannedConfig(self):
+    entries = self.ReadArchive(
+        common.RamdiskCpio(common.ParseFilesystemConfig(
+            open(self.fs_config).read())).Build(self.ramdisk))
+    self.assertEqual([e[0] for e in entries],
+                     ["data", "default.prop", "init", "init.rc", "sbin",
+                      "sbin/adbd", "sbin/ueventd", "system"])
+    modes = dict([(e[0], e[1]) for e in entries])
+    self.assertEqual(modes["data"], 040771)
+    self.assertEqual(modes["init"], 0100750)
+    self.assertEqual(modes["sbin/ueventd"], 0120777)
+    for e in entries:
+      self.assertEqual(e[2:4], (0, 0))
+
+  def testDefaultRules(self):
+    table = common.FsConfigTable("dir 750 0 2000 sbin\n"
+                                 "dir 755 0 0\n"
+                                 "file 750 0 2000 sbin/*\n"
+                                 "file 750 0 2000 init*\n"
+                                 "file 644 0 0\n")
+    entries = self.ReadArchive(common.RamdiskCpio(table).Build(self.ramdisk))
+    modes = dict([(e[0], e[1]) for e in entries])
+    self.assertEqual(modes["data"], 040755)
+    self.assertEqual(modes["sbin"], 040750)
+    self.assertEqual(modes["sbin/ueventd"], 0120750)
+    self.assertEqual(modes["init.rc"], 0100750)
+    self.assertEqual(modes["default.prop"], 0100644)
+
+  def testMatchesMkbootfs(self):
+    mkbootfs = FindProgram("mkbootfs")
+    if mkbootfs is None:
+      self.skipTest("no mkbootfs on the PATH")
+    p = subprocess.Popen([mkbootfs, "-f", self.fs_config, self.ramdisk],
+                         stdout=subprocess.PIPE)
+    expected, _ = p.communicate()
+    self.assertEqual(p.returncode, 0)
+    actual = common.RamdiskCpio(common.ParseFilesystemConfig(
+        open(self.fs_config).read())).Build(self.ramdisk)
+    self.assertEqual(self.ReadArchive(actual), self.ReadArchive(expected))
+    self.assertEqual(actual, expected)
+
+
+class ZipWriteTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.zip_name = os.path.join(self.tmp, "out.zip")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def Data(self, size):
+    lines = ["%08d\n" % (i,) for i in range(size // 9 + 1)]
+    return "".join(lines)[:size]
+
+  def Write(self, name, source, compression=zipfile.ZIP_DEFLATED, **kwargs):
+    output_zip = zipfile.ZipFile(self.zip_name, "w", compression)
+    common.ZipWriteStream(output_zip, name, source, **kwargs)
+    output_zip.close()
+    return zipfile.ZipFile(self.zip_name)
+
+  def testRechunk(self):
+    self.assertEqual(list(common._Rechunk(["ab", "cde", "f"], 4)),
+                     [("abcd", False), ("ef", True)])
+    self.assertEqual(list(common._Rechunk(["abcd"], 4)), [("abcd", True)])
+    self.assertEqual(list(common._Rechunk([], 4)), [("", True)])
+
+  def testParallelDeflateDoesNotDependOnThreads(self):
+    data = self.Data(3 * common.DEFLATE_CHUNK_SIZE)
+    saved = OPTIONS.zip_threads
+    try:
+      streams = []
+      for threads in (1, 4):
+        OPTIONS.zip_threads = threads
+        streams.append("".join([c for _, c in common.ParallelDeflate([data])]))
+    finally:
+      OPTIONS.zip_threads = saved
+    self.assertEqual(streams[0], streams[1])
+    self.assertEqual(zlib.decompress(streams[0], -15), data)
+
+  def testLargeEntry(self):
+    data = self.Data(2 * common.DEFLATE_CHUNK_SIZE + 12345)
+    input_zip = self.Write("large", [data[:1000], data[1000:]])
+    try:
+      self.assertEqual(input_zip.testzip(), None)
+      self.assertEqual(input_zip.read("large"), data)
+      info = input_zip.getinfo("large")
+      self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+      self.assertEqual(info.external_attr >> 16, 0644)
+    finally:
+      input_zip.close()
+
+  def testEmptyEntry(self):
+    input_zip = self.Write("empty", [])
+    try:
+      self.assertEqual(input_zip.testzip(), None)
+      self.assertEqual(input_zip.read("empty"), "")
+    finally:
+      input_zip.close()
+
+  def testStoredEntry(self):
+    data = self.Data(common.DEFLATE_CHUNK_SIZE + 1)
+    input_zip = self.Write("stored", [data], compress_type=zipfile.ZIP_STORED)
+    try:
+      self.assertEqual(input_zip.testzip(), None)
+      info = input_zip.getinfo("stored")
+      self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+      self.assertEqual(info.compress_size, len(data))
+      self.assertEqual(input_zip.read("stored"), data)
+    finally:
+      input_zip.close()
+
+  def CopyRaw(self, info, data, arcname=None):
+    """Write data to a deflated zip as info, ZipCopyRaw it into a zip
+    that is STORED by default, and return the copy, opened."""
+    source_name = os.path.join(self.tmp, "source.zip")
+    source_zip = zipfile.ZipFile(source_name, "w", zipfile.ZIP_DEFLATED)
+    source_zip.writestr(info, data)
+    source_zip.close()
+
+    source_zip = zipfile.ZipFile(source_name)
+    output_zip = zipfile.ZipFile(self.zip_name, "w", zipfile.ZIP_STORED)
+    try:
+      common.ZipCopyRaw(source_zip, output_zip, source_zip.getinfo(info.filename),
+                        arcname=arcname)
+    finally:
+      output_zip.close()
+      source_zip.close()
+    return zipfile.ZipFile(self.zip_name)
+
+  def testCopyRawRenamesAndKeepsDeflated(self):
+    data = self.Data(100000)
+    info = zipfile.ZipInfo("old", date_time=(2009, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0755 << 16
+    output_zip = self.CopyRaw(info, data, arcname="new")
+    try:
+      self.assertEqual(output_zip.testzip(), None)
+      self.assertEqual(output_zip.namelist(), ["new"])
+      copied = output_zip.getinfo("new")
+      self.assertEqual(copied.compress_type, zipfile.ZIP_DEFLATED)
+      self.assertTrue(copied.compress_size < len(data))
+      self.assertEqual(copied.external_attr >> 16, 0755)
+      self.assertEqual(output_zip.read("new"), data)
+    finally:
+      output_zip.close()
+
+  def testCopyRawDropsZip64Extra(self):
+    data = self.Data(1000)
+    other = struct.pack("<HH", 0xcafe, 2) + "xy"
+    info = zipfile.ZipInfo("entry", date_time=(2009, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.extra = struct.pack("<HHQQ", 1, 16, len(data), 0) + other
+    self.assertEqual(common._StripZip64Extra(info.extra), other)
+
+    output_zip = self.CopyRaw(info, data)
+    try:
+      self.assertEqual(output_zip.testzip(), None)
+      self.assertEqual(output_zip.getinfo("entry").extra, other)
+      self.assertEqual(output_zip.read("entry"), data)
+    finally:
+      output_zip.close()
+
+
+class RunInParallelTest(unittest.TestCase):
+
+  def testCallsEachItem(self):
+    done = []
+    common.RunInParallel(done.append, range(100), 4)
+    self.assertEqual(sorted(done), range(100))
+
+  def testReraisesFirstError(self):
+    started = []
+    def func(i):
+      started.append(i)
+      if i == 3:
+        raise ValueError(i)
+    def items():
+      for i in range(100):
+        yield i
+    self.assertRaises(ValueError, common.RunInParallel, func, items(), 1)
+    # Nothing is started after the failure.
+    self.assertEqual(started, [0, 1, 2, 3])
+
+
+class PatchJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, "journal")
+    self.sf = common.File("a", "source")
+    self.tf = common.File("a", "target")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def testResumesOnlyWithSameInputs(self):
+    journal = common.PatchJournal(self.path, ["target 1", "source 2"])
+    key = journal.Key(self.sf, self.tf, ["bsdiff"])
+    journal.Put(key, "patch")
+
+    journal = common.PatchJournal(self.path, ["target 1", "source 2"])
+    self.assertEqual(journal.Get(key), "patch")
+
+    journal = common.PatchJournal(self.path, ["target 1", "source 3"])
+    self.assertEqual(journal.Get(key), None)
+
+  def testRefusesOtherDirectory(self):
+    os.makedirs(self.path)
+    open(os.path.join(self.path, "precious"), "w").close()
+    self.assertRaises(common.ExternalError,
+                      common.PatchJournal, self.path, ["target 1"])
+    self.assertTrue(os.path.exists(os.path.join(self.path, "precious")))
+
+
+class FsConfigTableTest(unittest.TestCase):
+
+  TABLE = ("dir 771 1000 1000 data/app\n"
+           "dir 755 0 2000 system/bin\n"
+           "dir 755 0 0\n"
+           "file 550 1002 1002 system/etc/dbus.conf\n"
+           "file 6750 0 2000 system/bin/run-as\n"
+           "file 755 0 2000 system/bin/*\n"
+           "file 644 0 0\n")
+
+  def testRules(self):
+    table = common.FsConfigTable(self.TABLE)
+    # Directories match rules that are a prefix of their path.
+    self.assertEqual(table.Lookup("data/app", True), (1000, 1000, 0771))
+    self.assertEqual(table.Lookup("data/app/lib", True), (1000, 1000, 0771))
+    self.assertEqual(table.Lookup("data", True), (0, 0, 0755))
+    # Files match exactly, or by a prefix ending in "*".
+    self.assertEqual(table.Lookup("system/etc/dbus.conf", False),
+                     (1002, 1002, 0550))
+    self.assertEqual(table.Lookup("system/etc/dbus.conf.old", False),
+                     (0, 0, 0644))
+    self.assertEqual(table.Lookup("system/bin/run-as", False),
+                     (0, 2000, 06750))
+    self.assertEqual(table.Lookup("/system/bin/sh", False), (0, 2000, 0755))
+    self.assertEqual(table.Lookup("data/app", False), (0, 0, 0644))
+
+  def testIndexLooksUpEachPathOnce(self):
+    index = common.FsConfigIndex(common.FsConfigTable(self.TABLE))
+    self.assertEqual(index.Lookup([("system/bin", True),
+                                   ("system/bin/sh", False)]),
+                     {"system/bin": (0, 2000, 0755),
+                      "system/bin/sh": (0, 2000, 0755)})
+    self.assertEqual(index.Lookup([("system/bin/sh", False),
+                                   ("system/bin/ls", False)]),
+                     {"system/bin/sh": (0, 2000, 0755),
+                      "system/bin/ls": (0, 2000, 0755)})
+    self.assertEqual(len(index.ids), 3)
+    self.assertEqual(len(index.modes), 3)
+
+  def testMatchesFsConfig(self):
+    fs_config = FindProgram("fs_config")
+    if fs_config is None:
+      self.skipTest("no fs_config on the PATH")
+    table_name = os.path.join(os.path.dirname(fs_config), "fs_config.table")
+    if not os.path.exists(table_name):
+      self.skipTest("no fs_config.table next to %s" % (fs_config,))
+    table = common.FsConfigTable(open(table_name).read())
+
+    paths = [("system", True), ("system/bin", True), ("system/xbin", True),
+             ("system/etc", True), ("system/etc/ppp", True),
+             ("system/vendor/lib", True), ("data", True), ("data/app", True),
+             ("data/misc/dhcp", True), ("sbin", True), ("vendor", True),
+             ("system/bin/sh", False), ("system/bin/run-as", False),
+             ("system/bin/netcfg", False), ("system/xbin/su", False),
+             ("system/etc/dbus.conf", False), ("system/etc/ppp/ip-up", False),
+             ("system/etc/bluetooth/main.conf", False),
+             ("system/etc/hosts", False), ("system/app/Phone.apk", False),
+             ("system/lib/libc.so", False), ("system/build.prop", False),
+             ("vendor/bin/rild", False), ("sbin/adbd", False),
+             ("init", False), ("init.rc", False), ("fstab.device", False),
+             ("default.prop", False)]
+    p = subprocess.Popen([fs_config], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE)
+    output, _ = p.communicate("".join(["%s%s\n" % (name, dir and "/" or "")
+                                       for name, dir in paths]))
+    self.assertEqual(p.returncode, 0)
+    expected = common.ParseFilesystemConfig(output)
+    for name, dir in paths:
+      self.assertEqual(table.Lookup(name, dir), expected[name], name)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,60 @@
+# Copyright (C) 2014 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import imp
+import os
+import sys
+import unittest
+
+import common
+
+# ota_from_target_files is a script, not a .py module; load it without
+# leaving a compiled copy next to it.
+sys.dont_write_bytecode = True
+ota_from_target_files = imp.load_source(
+    "ota_from_target_files",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "ota_from_target_files"))
+sys.dont_write_bytecode = False
+
+
+class RenameIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.moved = common.File("system/app/Old.apk", "apk contents\n" * 100)
+    self.lib = common.File("system/lib/libfoo.so", "x" * 1000)
+    self.xml = common.File("system/etc/a.xml", "<a/>\n" * 200)
+    self.other = common.File("system/etc/b.bin", "y" * 1000)
+    self.index = ota_from_target_files.RenameIndex(
+        [self.moved, self.lib, self.xml, self.other])
+
+  def testFindsMovedFile(self):
+    tf = common.File("system/priv-app/New.apk", "apk contents\n" * 100)
+    self.assertTrue(self.index.Find(tf) is self.moved)
+
+  def testFindsSameBasename(self):
+    tf = common.File("system/lib/hw/libfoo.so", "z" * 3000)
+    self.assertTrue(self.index.Find(tf) is self.lib)
+
+  def testFindsSimilarSizeOfSameType(self):
+    tf = common.File("system/etc/c.xml", "<c/>\n" * 210)
+    self.assertTrue(self.index.Find(tf) is self.xml)
+
+  def testNoCandidate(self):
+    tf = common.File("system/fonts/Roboto.ttf", "font" * 5000)
+    self.assertEqual(self.index.Find(tf), None)
+
+
+if __name__ == "__main__":
+  unittest.main()
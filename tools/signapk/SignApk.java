@@ -91,6 +91,11 @@ class SignApk {
 
     private static Provider sBouncyCastleProvider;
 
+    // In batch mode, the password for the current job's private key,
+    // which is read from stdin along with the job.
+    private static boolean sBatchMode = false;
+    private static String sBatchPassword;
+
     // Files matching this pattern are not copied to the output.
     private static Pattern stripPattern =
         Pattern.compile("^(META-INF/((.*)[.](SF|RSA|DSA)|com/android/otacert))|(" +
@@ -113,6 +118,7 @@ class SignApk {
      * @param keyFile The file containing the private key.  Used to prompt the user.
      */
     private static String readPassword(File keyFile) {
+        if (sBatchMode) return sBatchPassword;
         // TODO: use Console.readPassword() when it's available.
         System.out.print("Enter password for " + keyFile + " (password will not be hidden): ");
         System.out.flush();
@@ -643,27 +649,31 @@ class SignApk {
                            "publickey.x509[.pem] privatekey.pk8 " +
                            "[publickey2.x509[.pem] privatekey2.pk8 ...] " +
                            "input.jar output.jar");
+        System.err.println("       signapk --batch");
         System.exit(2);
     }
 
-    public static void main(String[] args) {
-        if (args.length < 4) usage();
-
-        sBouncyCastleProvider = new BouncyCastleProvider();
-        Security.addProvider(sBouncyCastleProvider);
-
+    /**
+     * Sign inputFilename, writing the signed result to outputFilename.
+     *
+     * @param args The command-line arguments: an optional "-w", then
+     *             one or more public/private key filename pairs, then
+     *             the input and output filenames.
+     */
+    private static void sign(String[] args) throws Exception {
         boolean signWholeFile = false;
         int argstart = 0;
-        if (args[0].equals("-w")) {
+        if (args.length > 0 && args[0].equals("-w")) {
             signWholeFile = true;
             argstart = 1;
         }
 
-        if ((args.length - argstart) % 2 == 1) usage();
+        if (args.length - argstart < 4 || (args.length - argstart) % 2 == 1) {
+            throw new IllegalArgumentException("bad number of arguments");
+        }
         int numKeys = ((args.length - argstart) / 2) - 1;
         if (signWholeFile && numKeys > 1) {
-            System.err.println("Only one key may be used with -w.");
-            System.exit(2);
+            throw new IllegalArgumentException("Only one key may be used with -w.");
         }
 
         String inputFilename = args[args.length-2];
@@ -714,17 +724,70 @@ class SignApk {
                          publicKey, privateKey, outputJar);
                 outputJar.close();
             }
-        } catch (Exception e) {
-            e.printStackTrace();
-            System.exit(1);
         } finally {
+            if (inputJar != null) inputJar.close();
+            if (outputFile != null) outputFile.close();
+        }
+    }
+
+    /**
+     * Sign a series of files read from stdin, so that many files can
+     * be signed without starting a new JVM for each one.  Each job is
+     * two lines: the arguments for a normal invocation, separated by
+     * tabs, and the password for the job's private key (empty if the
+     * key isn't encrypted).  After each job, "OK" or "FAILED " and a
+     * message is written as a line to stdout.
+     */
+    private static void signBatch() throws IOException {
+        sBatchMode = true;
+        BufferedReader stdin = new BufferedReader(new InputStreamReader(System.in));
+        PrintStream stdout = System.out;
+        String line;
+        while ((line = stdin.readLine()) != null) {
+            sBatchPassword = stdin.readLine();
+            try {
+                sign(line.split("\t"));
+                stdout.println("OK");
+            } catch (Exception e) {
+                e.printStackTrace();
+                stdout.println("FAILED " + String.valueOf(e).replace('\n', ' '));
+            }
+            stdout.flush();
+        }
+    }
+
+    public static void main(String[] args) {
+        if (args.length == 1 && args[0].equals("--batch")) {
+            sBouncyCastleProvider = new BouncyCastleProvider();
+            Security.addProvider(sBouncyCastleProvider);
             try {
-                if (inputJar != null) inputJar.close();
-                if (outputFile != null) outputFile.close();
+                signBatch();
             } catch (IOException e) {
                 e.printStackTrace();
                 System.exit(1);
             }
+            return;
+        }
+
+        if (args.length < 4) usage();
+
+        sBouncyCastleProvider = new BouncyCastleProvider();
+        Security.addProvider(sBouncyCastleProvider);
+
+        boolean signWholeFile = args[0].equals("-w");
+        int argstart = signWholeFile ? 1 : 0;
+        if ((args.length - argstart) % 2 == 1) usage();
+        int numKeys = ((args.length - argstart) / 2) - 1;
+        if (signWholeFile && numKeys > 1) {
+            System.err.println("Only one key may be used with -w.");
+            System.exit(2);
+        }
+
+        try {
+            sign(args);
+        } catch (Exception e) {
+            e.printStackTrace();
+            System.exit(1);
         }
     }
 }